@@ -0,0 +1,291 @@
+#! /usr/bin/python
+
+"""
+    Benchmarks for the duplicate file database.
+
+    Measures the throughput of the operations in dup.py so that changes to
+    them can be compared.  Results are written to stdout as JSON.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import math
+import json
+import time
+import logging
+import random
+import shutil
+import hashlib
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+import dup
+
+MB = 1048576
+
+# The operations that the tree benchmark can measure
+operations = ("scan", "write", "duplicates", "integrity", "purge", "long")
+
+
+def benchHash(theSize, theAlgorithms, theBlockSizes, theRepeats):
+    """ Measure the throughput of dup.HashFile for each combination of hash
+        algorithm and block size.  The file is hashed from the page cache, so this
+        measures the cost of hashing rather than the speed of the disk
+
+        theSize:       The size of the file to hash, in MiB
+        theAlgorithms: A list of the names of the algorithms to measure
+        theBlockSizes: A list of the block sizes to measure, in bytes
+        theRepeats:    The number of times to hash the file.  The fastest time is reported
+
+        returns: A list of dictionaries, one per measurement
+    """
+    results = []
+    with tempfile.NamedTemporaryFile(prefix="dup-bench-") as afile:
+        for i in range(theSize):
+            afile.write(os.urandom(MB))
+        afile.flush()
+        dup.HashFile(afile.name)
+        for algorithm in theAlgorithms:
+            for blockSize in theBlockSizes:
+                dup.BLOCKSIZE = blockSize
+                best = None
+                for i in range(theRepeats):
+                    start = time.perf_counter()
+                    dup.HashFile(afile.name, algorithm)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                results.append({"benchmark": "hash", "algorithm": algorithm, "blocksize": blockSize,
+                                "bytes": theSize * MB, "seconds": best,
+                                "MBps": theSize / best})
+    return results
+
+
+def makeTree(theRoot, theFiles, theMinSize, theMaxSize, theDuplicates, theDepth, theSeed):
+    """ Build a synthetic directory tree.  The same parameters always build the
+        same tree
+
+        theRoot:       The directory to build the tree in
+        theFiles:      The number of files to create
+        theMinSize:    The size of the smallest file, in bytes
+        theMaxSize:    The size of the largest file, in bytes.  Sizes are distributed
+                       uniformly on a log scale between theMinSize and theMaxSize
+        theDuplicates: The fraction of the files that are copies of another file
+        theDepth:      The number of levels of directories.  The number of
+                       directories at each level is chosen so that each directory at
+                       the bottom holds about 100 files
+        theSeed:       The seed for the random number generator
+
+        returns: A tuple of the number of files and the total number of bytes written
+    """
+    rng = random.Random(theSeed)
+    fanout = max(1, int(round((theFiles / 100.0) ** (1.0 / theDepth)))) if theDepth else 1
+    (unique, total) = ([], 0)
+    for i in range(theFiles):
+        if unique and rng.random() < theDuplicates:
+            (seed, size) = rng.choice(unique)
+        else:
+            seed = rng.getrandbits(64)
+            size = int(math.exp(rng.uniform(math.log(theMinSize), math.log(theMaxSize))))
+            unique.append((seed, size))
+        directory = os.path.join(theRoot, *["d%03d" % rng.randrange(fanout) for j in range(theDepth)])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f%07d" % i), "wb") as afile:
+            afile.write(random.Random(seed).randbytes(size))
+        total += size
+    return (theFiles, total)
+
+
+def openDatabase(theFileName):
+    """ Open a database for a benchmark, setting up the globals in dup that main
+        would have set
+
+        theFileName: The name of the database file
+        returns:     None
+    """
+    dup.DRY_RUN = True
+    dup.initDB(theFileName)
+
+
+def runOperation(theOperation, theRoot, theDatabase, theSeed):
+    """ Run one operation against a database.  Output is discarded
+
+        theOperation: One of operations
+        theRoot:      The root of the synthetic tree
+        theDatabase:  The name of the database file to use
+        theSeed:      The seed for the random number generator
+
+        returns: The number of bytes of file data the operation reads
+    """
+    openDatabase(theDatabase)
+    rng = random.Random(theSeed)
+    (reads, database) = (0, dup.theDatabase)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if theOperation == "scan":
+            dup.HashDir(theRoot)
+            reads = database.con.execute("select sum(size) from files").fetchone()[0]
+        elif theOperation == "write":
+            database.writeMany((hashlib.sha256(path.encode()).hexdigest(), path, stat, None)
+                               for path, stat, links in dup.WalkDir(theRoot))
+        elif theOperation == "duplicates":
+            database.DupCheck()
+        elif theOperation == "integrity":
+            database.Integrity()
+            reads = database.con.execute("select sum(size) from files").fetchone()[0]
+        elif theOperation == "purge":
+            directories = [x[0] for x in os.walk(theRoot)]
+            for directory in rng.sample(directories, min(10, len(directories))):
+                database.Purge(directory)
+        elif theOperation == "long":
+            database.lat(rng.uniform(-90, 90))
+            database.long(rng.uniform(-180, 180))
+    database.close()
+    return reads or 0
+
+
+def measureOperation(theConnection, theOperation, theRoot, theDatabase, theSeed):
+    """ Body of the child process that measures one operation.  Each operation runs in
+        its own process so that its peak memory use can be measured
+
+        theConnection: The end of a pipe on which to send the result
+        returns:       None
+    """
+    start = time.perf_counter()
+    reads = runOperation(theOperation, theRoot, theDatabase, theSeed)
+    elapsed = time.perf_counter() - start
+    theConnection.send({"seconds": elapsed, "bytes": reads,
+                        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def benchTree(theFiles, theMinSize, theMaxSize, theDuplicates, theDepth, theSeed,
+              theOperations, theJobs, theDropCaches, theWorkDir):
+    """ Build a synthetic tree and measure each operation against a fresh copy of a
+        database
+
+        theFiles, theMinSize, theMaxSize, theDuplicates, theDepth, theSeed:
+                       The parameters of the tree, as for makeTree
+        theOperations: A list of the operations to measure
+        theJobs:       The value of dup.JOBS to use
+        theDropCaches: If True, drop the page cache before each operation.  This
+                       requires root
+        theWorkDir:    The directory in which to build the tree, or None for a
+                       temporary directory
+
+        returns: A list of dictionaries, one per operation
+    """
+    dup.JOBS = theJobs
+    results = []
+    work = tempfile.mkdtemp(prefix="dup-bench-", dir=theWorkDir)
+    try:
+        root = os.path.join(work, "tree")
+        (files, total) = makeTree(root, theFiles, theMinSize, theMaxSize, theDuplicates, theDepth, theSeed)
+
+        # Every operation except scan and write starts from a copy of a database
+        # that holds the whole tree
+
+        scanned = os.path.join(work, "scanned.sqlite")
+        context = multiprocessing.get_context("fork")
+        process = context.Process(target=runOperation, args=("scan", root, scanned, theSeed))
+        process.start()
+        process.join()
+        openDatabase(scanned)
+        rng = random.Random(theSeed)
+        with dup.theDatabase.con as con:
+            con.executemany("insert or replace into metadata (hash, latitude, longitude) values (?,?,?)",
+                            ((x[0], rng.uniform(-90, 90), rng.uniform(-180, 180)) for x in
+                             con.execute("select distinct hash from files where hash not null").fetchall()))
+        dup.theDatabase.close()
+
+        for operation in theOperations:
+            database = os.path.join(work, "%s.sqlite" % operation)
+            if operation not in ("scan", "write"):
+                shutil.copy(scanned, database)
+            if theDropCaches:
+                subprocess.run(["sync"])
+                with open("/proc/sys/vm/drop_caches", "w") as afile:
+                    afile.write("3\n")
+            (receiver, sender) = context.Pipe(duplex=False)
+            process = context.Process(target=measureOperation,
+                                      args=(sender, operation, root, database, theSeed))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                raise RuntimeError("Operation %s failed" % operation)
+            finally:
+                process.join()
+            result.update({"benchmark": "tree", "operation": operation, "files": files,
+                           "files_per_second": files / result["seconds"],
+                           "MBps": result["bytes"] / MB / result["seconds"] if result["bytes"] else None})
+            results.append(result)
+    finally:
+        shutil.rmtree(work)
+    return results
+
+
+def gitCommit():
+    """ Return the commit of the working tree that dup.py is in, if it is in a git
+        repository, so that results can be compared across commits.  None otherwise
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(dup.__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR, format=dup.logFormat)
+    parser = ArgumentParser(description="Benchmarks for dup.py")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("hash", help="Hashing throughput")
+    command.add_argument("--size", type=int, default=256, help="Size of the file to hash, in MiB")
+    command.add_argument("--algorithms", nargs="+", default=sorted(dup.hashAlgorithms),
+                         choices=sorted(dup.hashAlgorithms), help="Hash algorithms to measure")
+    command.add_argument("--blocksizes", nargs="+", type=int,
+                         default=[65536, 262144, 1048576, 4194304], help="Block sizes to measure, in bytes")
+    command.add_argument("--repeats", type=int, default=3, help="Number of times to hash the file")
+    command = commands.add_parser("tree", help="Operations on a synthetic directory tree")
+    command.add_argument("--files", type=int, default=10000, help="Number of files in the tree")
+    command.add_argument("--min-size", type=int, default=1024, help="Size of the smallest file, in bytes")
+    command.add_argument("--max-size", type=int, default=65536, help="Size of the largest file, in bytes")
+    command.add_argument("--duplicates", type=float, default=0.2, help="Fraction of files that are duplicates")
+    command.add_argument("--depth", type=int, default=3, help="Levels of directories")
+    command.add_argument("--seed", type=int, default=1, help="Seed for the random number generator")
+    command.add_argument("--operations", nargs="+", default=list(operations), choices=operations,
+                         help="Operations to measure")
+    command.add_argument("--jobs", type=int, default=1, help="Number of files to hash in parallel")
+    command.add_argument("--drop-caches", action="store_true",
+                         help="Drop the page cache before each operation (requires root)")
+    command.add_argument("--workdir", default=None, help="Directory in which to build the tree")
+    args = parser.parse_args()
+
+    if args.command == "hash":
+        results = benchHash(args.size, args.algorithms, args.blocksizes, args.repeats)
+    elif args.command == "tree":
+        results = benchTree(args.files, args.min_size, args.max_size, args.duplicates, args.depth,
+                            args.seed, args.operations, args.jobs, args.drop_caches, args.workdir)
+    else:
+        parser.print_help()
+        sys.exit(1)
+    print(json.dumps({"commit": gitCommit(), "parameters": vars(args), "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
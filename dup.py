@@ -24,95 +24,668 @@
 
 """
 import os
+import sys
+import errno
 import logging
 import hashlib
 import math
+import random
+import stat
+import fcntl
+import select
+import struct
+import shutil
+import csv
+import json
+import itertools
+import fnmatch
+import re
+import datetime
+import heapq
+import queue
+import threading
+import time
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import namedtuple, Counter
 from argparse import ArgumentParser
 import sqlite3
-try:
-    import argcomplete
-    argcompleteAvailable=True
-except ImportError:
-    argcompleteAvailable=False
-try:
-    import gi
-    gi.require_version('GExiv2', '0.10')
-    from gi.repository import GExiv2
-    exifAvailable=True
-except ImportError:
-    exifAvailable=False
-except ValueError:
-    exifAvailable=False
+
+# Optional modules, and modules that only some actions need, are imported by the
+# action that needs them, so that the others start quickly.  loadExif and loadInotify
+# set exifAvailable and inotifyAvailable, which are None until they are tried
+xxhashAvailable = importlib.util.find_spec("xxhash") is not None
+exifAvailable = None
+inotifyAvailable = None
 theDatabase = None
-BLOCKSIZE = 65536
+BLOCKSIZE = 1048576
+PARTIAL_BLOCKSIZE = 65536
+ALGORITHM = "sha256"
+LINK_MODE = None
+SUBTREE = None
+FICLONE = 0x40049409
 DRY_RUN = None
+STAGED = None
+REHASH = None
+JOBS = 1
+BATCHSIZE = 1000
+OUTPUT_FORMAT = "text"
+VERIFY = "full"
+SAMPLE = 1.0
+RESUME = None
+COMMIT_INTERVAL = 2
+PROGRESS_INTERVAL = 1
+ISOLATED_TIMEOUT = 60
+LIMIT = None
+RADIUS = None
+UNIQUE = None
+SINCE = None
+UNTIL = None
+EARTH_RADIUS = 6371.0
+MAP_MAX_ZOOM = 14
+MAP_CELL = 64
+WATCH_DELAY = 2
+COMPARE_FILES = 64
+EXCLUDE = None
+MIN_SIZE = None
+MAX_SIZE = None
+ONE_FILE_SYSTEM = None
+SYMLINKS = "files"
+HOST = None
 logFormat = '%(relativeCreated)6dmS (%(threadName)s) %(levelname)s : %(message)s'
 default_DB = os.environ['HOME'] +'/.dup.sqlite'
 
+# The buffers that HashFile reads into, one for each thread
+readBuffers = threading.local()
+
+# The hash algorithms that can be used, by the name recorded in the database.  xxh3_128
+# is not a cryptographic hash, but is much faster
+hashAlgorithms = {"sha256": hashlib.sha256,
+                  "blake2b": hashlib.blake2b,
+                 }
+
+def xxh3_128():
+    """ Return a new xxh3_128 hasher, importing xxhash the first time """
+    import xxhash
+    return xxhash.xxh3_128()
+
+if xxhashAvailable:
+    hashAlgorithms["xxh3_128"] = xxh3_128
+
+# Files that may hold exif data that GExiv2 can read, by extension, and by their first
+# bytes.  exifBrands are the ISO base media file types (HEIF, AVIF, CR3) at offset 8
+exifExtensions = {".jpg", ".jpeg", ".jpe", ".tif", ".tiff", ".png", ".webp", ".heic", ".heif",
+                  ".avif", ".jp2", ".psd", ".dng", ".cr2", ".cr3", ".crw", ".nef", ".nrw", ".arw",
+                  ".sr2", ".srw", ".orf", ".rw2", ".raf", ".pef", ".mrw", ".exv"}
+exifSignatures = (b"\xff\xd8\xff", b"II*\x00", b"MM\x00*", b"\x89PNG\r\n\x1a\n", b"8BPS",
+                  b"II\x1a\x00\x00\x00HEAPCCDR", b"FUJIFILMCCD-RAW", b"\x00\x00\x00\x0cjP  ",
+                  b"IIRO", b"IIU\x00", b"\x00MRM", b"Exiv2")
+exifBrands = {b"heic", b"heix", b"heim", b"heis", b"mif1", b"msf1", b"avif", b"crx "}
+
+# Dates and times, as found in exif data, and as given on the command line, where they
+# may be shortened
+dateTimePattern = re.compile(r"(\d{4})[:-](\d{2})[:-](\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?")
+dateBoundPattern = re.compile(r"(\d{4})(?:[:-](\d{2})(?:[:-](\d{2})(?:[ T](\d{2})"
+                              r"(?::(\d{2})(?::(\d{2}))?)?)?)?)?$")
+
+# The stat information recorded for each file.  A file whose stat information has
+# not changed since it was hashed is not hashed again
+FileStat = namedtuple('FileStat', ('size', 'mtime_ns', 'inode', 'device'))
+
 class Database:
     """ Class to manage the life cycle of the sqlite3 database"""
 
-    tables = (("files", "path", "hash"),
-              ("metadata", "hash", "dateTime","latitude","longitude","altitude"),
-             )
+    # The version of the schema written by this program.  It is stored in the database
+    # as PRAGMA user_version.  Databases written before the schema was versioned are
+    # version 0.  upgradeToVn upgrades a database from version n-1 to version n
+    schemaVersion = 8
     latitude=None
     longitude=None
     
     def __init__(self, theFileName):
         """ Constructor
-              Opens the database, creating it if necessary.  Checks that the required
-              tables exist, and ifthey do not exist, it creates them
+              Opens the database, creating it if necessary.  Checks the version of the
+              schema, and creates or upgrades the tables as required
 
               theFileName:  The name of the data base file to open
               returns: None
         """
+        self.fileName = theFileName
         self.con = sqlite3.connect(theFileName)
-        with self.con:
-            cur = self.con.cursor()
-            cur.execute("select name from sqlite_master where type='table';")
-            existingTables = cur.fetchall()
 
-            # Walk through all the table names and see if they exist.  Create them if they do not
+        # The files that verifyGroup has found to be identical in this run, by hash
 
-            for x in self.tables:
-                if len(existingTables) > 0 and (x[0] in [z[0] for z in existingTables]):
-                    logging.debug("Table %s exists in database", x[0])
-                    continue
-                else:
+        self.verified = {}
 
-                    # Build the sql command to add the table and all of its comma delimited columns.
+        # Write ahead logging lets readers continue while a scan is writing, and
+        # with it, the database only needs to be synced at checkpoints
 
-                    logging.info("Creating table %s", x[0])
-                    (s, separator) = ("CREATE TABLE %s(" % x[0], '')
-                    for z in x[1:]:
-                        (s, separator) = (s + separator + z + ' text', ',')
-                    cur.execute("%s)"%s)
-            self.con.commit()
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.execute("PRAGMA cache_size=-65536")
+
+        # Rows that INSERT OR REPLACE deletes must fire the delete triggers that keep
+        # the spatial index up to date
+
+        self.con.execute("PRAGMA recursive_triggers=ON")
+        cur = self.con.cursor()
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        if version > self.schemaVersion:
+            logging.warning("Database %s was written by a newer version of this program", theFileName)
+        self.compact = False
+        for version in range(version + 1, self.schemaVersion + 1):
+            logging.info("Upgrading database schema to version %d", version)
+            try:
+                cur.execute("BEGIN")
+                getattr(self, "upgradeToV%d" % version)(cur)
+                cur.execute("PRAGMA user_version=%d" % version)
+                self.con.commit()
+            except:
+                self.con.rollback()
+                raise
+
+        # An upgrade that makes the tables smaller leaves free pages in the file
+
+        if self.compact:
+            logging.info("Compacting database %s", theFileName)
+            self.con.execute("VACUUM")
+
+    def upgradeToV1(self, cur):
+        """ Create the files and metadata tables with keys and indexes.  Tables written
+            by older versions are copied into the new tables, and then dropped.  Any
+            duplicate rows in those tables are merged.
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("select name from sqlite_master where type='table';")
+        existingTables = [z[0] for z in cur.fetchall()]
+        for table in ("files", "metadata"):
+            if table in existingTables:
+                cur.execute("ALTER TABLE %s RENAME TO old_%s" % (table, table))
+
+        cur.execute("CREATE TABLE files(path TEXT PRIMARY KEY NOT NULL, hash TEXT, "
+                    "size INTEGER, partial TEXT, mtime_ns INTEGER, inode INTEGER, device INTEGER)")
+        cur.execute("CREATE INDEX files_hash ON files(hash)")
+        cur.execute("CREATE INDEX files_size ON files(size)")
+        cur.execute("CREATE TABLE metadata(hash TEXT PRIMARY KEY NOT NULL, dateTime TEXT, "
+                    "latitude REAL, longitude REAL, altitude REAL)")
+
+        if "files" in existingTables:
+            logging.info("Copying table files")
+            cur.execute("PRAGMA table_info(old_files)")
+            existingColumns = [z[1] for z in cur.fetchall()]
+            columns = ",".join(z if z in existingColumns else "null" for z in
+                               ("path", "hash", "size", "partial", "mtime_ns", "inode", "device"))
+
+            # Older versions did not prevent duplicate rows.  Keep the newest one
+
+            cur.execute("INSERT OR REPLACE INTO files SELECT %s FROM old_files "
+                        "WHERE path NOT NULL ORDER BY rowid" % columns)
+            cur.execute("DROP TABLE old_files")
+
+        if "metadata" in existingTables:
+            logging.info("Copying table metadata")
+            cur.execute("INSERT INTO metadata SELECT hash, max(dateTime), "
+                        "max(CAST(nullif(latitude, '') AS REAL)), "
+                        "max(CAST(nullif(longitude, '') AS REAL)), "
+                        "max(CAST(nullif(altitude, '') AS REAL)) "
+                        "FROM old_metadata WHERE hash NOT NULL GROUP BY hash")
+            cur.execute("DROP TABLE old_metadata")
+
+    def upgradeToV2(self, cur):
+        """ Add the checkpoints table, which records how far a long running task
+            has got so that it can be resumed
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("CREATE TABLE checkpoints(task TEXT PRIMARY KEY NOT NULL, position TEXT)")
+
+    def upgradeToV3(self, cur):
+        """ Record the algorithm used to calculate the hash and partial hash of each
+            file.  Older versions always used sha256
 
-    def write(self, theHash, thePath):
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("ALTER TABLE files ADD COLUMN algorithm TEXT")
+        cur.execute("UPDATE files SET algorithm='sha256'")
+
+    def upgradeToV4(self, cur):
+        """ Index files by device and inode, so that hard links to a file that has
+            already been hashed can be found
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("CREATE INDEX files_inode ON files(device, inode)")
+
+    def upgradeToV5(self, cur):
+        """ Give metadata an integer key, and index the locations in it with an R*Tree
+            that triggers keep up to date.  Locations within 0.00001 degrees of the
+            equator or the prime meridian are taken to be missing, and are not indexed.
+            If this sqlite was built without the R*Tree module, latitude and longitude
+            are indexed instead
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("ALTER TABLE metadata RENAME TO old_metadata")
+        cur.execute("CREATE TABLE metadata(id INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL, "
+                    "dateTime TEXT, latitude REAL, longitude REAL, altitude REAL)")
+        cur.execute("INSERT INTO metadata (hash, dateTime, latitude, longitude, altitude) "
+                    "SELECT hash, dateTime, latitude, longitude, altitude FROM old_metadata")
+        cur.execute("DROP TABLE old_metadata")
+        try:
+            cur.execute("CREATE VIRTUAL TABLE locations USING rtree(id, minLat, maxLat, minLong, maxLong)")
+        except sqlite3.OperationalError as e:
+            logging.warning("No spatial index (%s).  Indexing latitude and longitude instead", e)
+            cur.execute("CREATE INDEX metadata_location ON metadata(latitude, longitude)")
+            return
+        located = ("%(row)s.latitude NOT NULL AND %(row)s.longitude NOT NULL "
+                   "AND abs(%(row)s.latitude) > 0.00001 AND abs(%(row)s.longitude) > 0.00001")
+        cur.execute("CREATE TRIGGER metadata_locations_insert AFTER INSERT ON metadata "
+                    "WHEN %s BEGIN "
+                    "  INSERT INTO locations VALUES (new.id, new.latitude, new.latitude, "
+                    "                                new.longitude, new.longitude); "
+                    "END" % (located % {"row": "new"}))
+        cur.execute("CREATE TRIGGER metadata_locations_update AFTER UPDATE OF id, latitude, longitude "
+                    "ON metadata BEGIN "
+                    "  DELETE FROM locations WHERE id = old.id; "
+                    "  INSERT INTO locations SELECT new.id, new.latitude, new.latitude, "
+                    "                               new.longitude, new.longitude WHERE %s; "
+                    "END" % (located % {"row": "new"}))
+        cur.execute("CREATE TRIGGER metadata_locations_delete AFTER DELETE ON metadata BEGIN "
+                    "  DELETE FROM locations WHERE id = old.id; "
+                    "END")
+        cur.execute("INSERT INTO locations SELECT id, latitude, latitude, longitude, longitude "
+                    "FROM metadata WHERE %s" % (located % {"row": "metadata"}))
+
+    def upgradeToV6(self, cur):
+        """ Store dates and times as "YYYY-MM-DD HH:MM:SS", which sorts in time order,
+            rather than in the form they have in the exif data, and index them
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("SELECT id, dateTime FROM metadata WHERE dateTime NOT NULL")
+        cur.executemany("UPDATE metadata SET dateTime=? WHERE id=?",
+                        [(normalDateTime(x[1]), x[0]) for x in cur.fetchall()])
+        cur.execute("CREATE INDEX metadata_dateTime ON metadata(dateTime, hash)")
+
+    def upgradeToV7(self, cur):
+        """ Store hashes in binary rather than in hex, and record each directory once,
+            in the dirs table, so that files only records the name of each file and the
+            id of its directory.  The path of a file is the path of its directory, "/"
+            and its name.  The root directory is recorded as "".  Files are keyed on
+            directory and name, without a rowid.  The hashes in metadata are converted
+            in place, as SQLite keeps a BLOB in a column declared TEXT, so the spatial
+            index and its triggers are not touched.  Integrity checks that were
+            interrupted cannot be resumed, as they recorded a path
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.connection.create_function("hexToBlob", 1, hashToBlob, deterministic=True)
+        cur.connection.create_function("dirName", 1, lambda x: splitPath(x)[0], deterministic=True)
+        cur.connection.create_function("baseName", 1, lambda x: splitPath(x)[1], deterministic=True)
+        for index in ("files_hash", "files_size", "files_inode"):
+            cur.execute("DROP INDEX %s" % index)
+        cur.execute("ALTER TABLE files RENAME TO old_files")
+        cur.execute("CREATE TABLE dirs(id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL)")
+        cur.execute("CREATE TABLE files(dir INTEGER NOT NULL, name TEXT NOT NULL, hash BLOB, "
+                    "size INTEGER, partial BLOB, mtime_ns INTEGER, inode INTEGER, device INTEGER, "
+                    "algorithm TEXT, PRIMARY KEY (dir, name)) WITHOUT ROWID")
+        cur.execute("INSERT INTO dirs (path) SELECT DISTINCT dirName(path) FROM old_files ORDER BY 1")
+        cur.execute("INSERT INTO files SELECT dirs.id, baseName(old_files.path), hexToBlob(hash), size, "
+                    "hexToBlob(partial), mtime_ns, inode, device, algorithm "
+                    "FROM old_files JOIN dirs ON dirs.path = dirName(old_files.path) ORDER BY 1, 2")
+        self.compact = cur.rowcount > 0
+        cur.execute("DROP TABLE old_files")
+        cur.execute("CREATE INDEX files_hash ON files(hash)")
+        cur.execute("CREATE INDEX files_size ON files(size)")
+        cur.execute("CREATE INDEX files_inode ON files(device, inode)")
+        cur.execute("UPDATE metadata SET hash = hexToBlob(hash)")
+        cur.execute("DELETE FROM checkpoints WHERE task='check'")
+
+    def upgradeToV8(self, cur):
+        """ Add the scans table, which records each scan that has not finished, and the
+            scanned table, which records the directories that each of those scans has
+            completed, so that an interrupted scan can be resumed
+
+            cur:     A cursor on the database, within a transaction
+            returns: None
+        """
+        cur.execute("CREATE TABLE scans(id INTEGER PRIMARY KEY, root TEXT UNIQUE NOT NULL, started TEXT)")
+        cur.execute("CREATE TABLE scanned(scan INTEGER NOT NULL, path TEXT NOT NULL, "
+                    "PRIMARY KEY (scan, path)) WITHOUT ROWID")
+
+    def write(self, theHash, thePath, theStat=None, thePartial=None):
         """ Write the path and its hash to the database if the path does
             not already exist.  If it exists, but the hash is changed,
             the hash is updated and a warning issued
 
-            theHash:  The hash of the file
-            thePath:  The full path to the file
+            theHash:    The hash of the file.  None if the file was not hashed
+            thePath:    The full path to the file
+            theStat:    A FileStat for the file, if known
+            thePartial: The hash of the first and last blocks of the file, if known
+            returns:  None
+        """
+        self.writeMany(((theHash, thePath, theStat, thePartial), ))
+
+    def writeMany(self, theRecords, theBatchSize=None, theInterval=None):
+        """ Write many files to the database.  This is the bulk form of write.  Records
+            are written in batches, and each batch is committed when it holds
+            theBatchSize records, or when theInterval seconds have passed since the
+            last commit, whichever comes first.
+
+            theRecords:   An iterable of (hash, path, FileStat, partial) tuples, as taken
+                          by write.  The hashes must have been calculated with ALGORITHM.
+                          An empty tuple writes nothing, but lets a batch that has waited
+                          for theInterval seconds be committed
+            theBatchSize: The maximum number of records per transaction.  Default BATCHSIZE
+            theInterval:  The maximum number of seconds between commits.  Default COMMIT_INTERVAL
             returns:  None
         """
+        theBatchSize = theBatchSize or BATCHSIZE
+        theInterval = theInterval or COMMIT_INTERVAL
+        batch, lastCommit = [], time.monotonic()
+        try:
+            for record in theRecords:
+                if record:
+                    (theHash, thePath, theStat, thePartial) = record
+                    batch.append((thePath, theHash, thePartial, ALGORITHM) +
+                                 tuple(theStat or FileStat(None, None, None, None)))
+                if batch and (len(batch) >= theBatchSize or
+                              time.monotonic() - lastCommit >= theInterval):
+                    (batch, pending) = ([], batch)
+                    self.flushBatch(pending)
+                    lastCommit = time.monotonic()
+        finally:
+            self.flushBatch(batch)
+
+    def flushBatch(self, theBatch):
+        """ Write and commit one batch of records for writeMany
+
+            theBatch: A list of (path, hash, partial, algorithm, size, mtime_ns, inode, device) tuples
+            returns:  None
+        """
+        if not theBatch:
+            return
+        start = time.perf_counter()
         with self.con:
             cur = self.con.cursor()
-            cur.execute("select * from files where path=:p", {"p":thePath})
-            matchingRecords = cur.fetchall()
-            if len(matchingRecords) == 0:
-                logging.debug("Writing %s to the database", thePath)
-                cur.execute("insert into files values(?,?);", (thePath, theHash))
-            else:
-                if len(matchingRecords) > 1:
-                    logging.warning("Santity check failure.  Multiple database enties for %s",
-                                    thePath)
-                if matchingRecords[0][1] != theHash:
-                    logging.warning("Hash changed for %s", thePath)
-                    logging.info("Updating hash to  %s ", theHash)
-                    cur.execute("update files set hash=? where path=?", (theHash, thePath))
+
+            # Warn about files whose hash has changed since they were last scanned
+
+            rows = [key + (hashToBlob(x[1]), hashToBlob(x[2])) + x[3:]
+                    for (key, x) in zip(self.dirIds(x[0] for x in theBatch), theBatch)]
+            newHashes = dict((x[:2], x[2]) for x in rows if x[2])
+            keys = list(newHashes)
+            for i in range(0, len(keys), 250):
+                chunk = keys[i:i + 250]
+                cur.execute("with batch(dir, name) as (values %s) "
+                            "select dirs.path || '/' || files.name, files.dir, files.name, files.hash "
+                            "from batch join files on files.dir = batch.dir and files.name = batch.name "
+                            "join dirs on dirs.id = files.dir "
+                            "where files.hash not null and files.algorithm=?" % ",".join(["(?,?)"] * len(chunk)),
+                            [y for x in chunk for y in x] + [ALGORITHM])
+                for (thePath, theDir, theName, oldHash) in cur.fetchall():
+                    if oldHash != newHashes[(theDir, theName)]:
+                        logging.warning("Hash changed for %s", thePath)
+                        logging.info("Updating hash to  %s ", blobToHash(newHashes[(theDir, theName)]))
+
+            # A staged scan does not hash files of unique size, and a file that cannot be
+            # read has no hash.  Keep what we already know about such a file only if its
+            # size, modification time, inode, device and the hash algorithm are all
+            # unchanged.  Otherwise its contents may have changed, so its old hash is dropped
+
+            logging.debug("Writing %d files to the database", len(theBatch))
+            unchanged = ("excluded.size = files.size and excluded.mtime_ns = files.mtime_ns "
+                         "and excluded.inode = files.inode and excluded.device = files.device "
+                         "and excluded.algorithm = files.algorithm")
+            cur.executemany(
+                "insert into files (dir, name, hash, partial, algorithm, size, mtime_ns, inode, device) "
+                "values (?,?,?,?,?,?,?,?,?) "
+                "on conflict(dir, name) do update set "
+                "  hash = case when excluded.hash is null and %s "
+                "              and (excluded.partial is null or excluded.partial = files.partial) "
+                "         then files.hash else excluded.hash end, "
+                "  partial = case when excluded.partial is null and %s "
+                "                 and (excluded.hash is null or excluded.hash = files.hash) "
+                "            then files.partial else excluded.partial end, "
+                "  algorithm = excluded.algorithm, "
+                "  size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                "  inode = excluded.inode, device = excluded.device" % (unchanged, unchanged),
+                rows)
+            if SESSION:
+                SESSION.written(self.con, [x[0] for x in theBatch])
+        STATS.addTime("database", time.perf_counter() - start)
+        STATS.count("rows_written", len(theBatch))
+
+        # A file hashed without a partial hash was not found by a staged scan, so files
+        # of the same size that a staged scan recorded without a hash were never
+        # compared with it
+
+        self.hashSizes(set(x[4] for x in theBatch if x[1] and not x[2] and x[4] is not None))
+
+    def hashSizes(self, theSizes):
+        """ Fully hash the files in the database that have no hash and are one of the
+            given sizes.  A file that has changed since it was recorded is skipped, as
+            it is brought up to date when its own tree is scanned
+
+            theSizes: A collection of file sizes, in bytes
+            returns:  None
+        """
+        theSizes = list(theSizes)
+        candidates = []
+        for i in range(0, len(theSizes), 250):
+            chunk = theSizes[i:i + 250]
+            candidates.extend(x for x in self.con.execute(
+                "select dirs.path || '/' || files.name, files.dir, files.name, files.device, files.inode, "
+                "files.size, files.mtime_ns from files join dirs on dirs.id = files.dir "
+                "where files.hash is null and files.size in (%s)" % ",".join("?" * len(chunk)), chunk)
+                              if isUnchanged(x[0], x[5], x[6]))
+        if not candidates:
+            return
+        logging.info("Hashing %d files of the same size as new files", len(candidates))
+        hashes = mapInodes(HashFile, [x[3:5] for x in candidates], [x[0] for x in candidates])
+        self.updateMany("update %s set hash=?, partial = case when algorithm is ? then partial end, "
+                        "algorithm=? where dir=? and name=?",
+                        (("files", (hashToBlob(theHash), ALGORITHM, ALGORITHM, theDir, theName))
+                         for (path, theDir, theName, device, inode, size, mtime), theHash in
+                         zip(candidates, hashes) if theHash))
+
+    def updateMany(self, theStatement, theRows, theBatchSize=None):
+        """ Apply an update to many rows of the files table or the temporary scan
+            table, committing theBatchSize rows at a time, as writeMany does
+
+            theStatement: The update statement, with %s in place of the table name
+            theRows:      An iterable of (table, parameters) tuples, where table is
+                          "files" or "scan"
+            theBatchSize: The maximum number of rows per transaction.  Default BATCHSIZE
+            returns:      None
+        """
+        theRows = iter(theRows)
+        while True:
+            batch = list(itertools.islice(theRows, theBatchSize or BATCHSIZE))
+            if not batch:
+                return
+            start = time.perf_counter()
+            with self.con:
+                for table in ("files", "scan"):
+                    rows = [x[1] for x in batch if x[0] == table]
+                    if rows:
+                        self.con.executemany(theStatement % table, rows)
+            STATS.addTime("database", time.perf_counter() - start)
+
+    def dirIds(self, thePaths):
+        """ Find the directories of files in the dirs table, adding those that are not
+            there yet.  The ids are only kept for the life of the generator, as a
+            directory that is added is lost if the transaction is rolled back
+
+            thePaths: An iterable of full paths to files
+            returns:  A generator of (dir, name) tuples, one for each path, where dir is
+                      the id of the directory of the file in the dirs table
+        """
+        ids = {}
+        for thePath in thePaths:
+            (directory, name) = splitPath(thePath)
+            if directory not in ids:
+                self.con.execute("insert or ignore into dirs (path) values (?)", (directory, ))
+                ids[directory] = self.con.execute("select id from dirs where path=?",
+                                                  (directory, )).fetchone()[0]
+            yield (ids[directory], name)
+
+    def pruneDirs(self, thePath="/"):
+        """ Remove the directories that no longer hold any files from the dirs table
+
+            thePath: Only directories that are thePath, or are below it, are removed
+            returns: None
+        """
+        (condition, parameters) = dirRange(thePath)
+        self.con.execute("delete from dirs where %s and not exists "
+                         "(select 1 from files where files.dir = dirs.id)" % condition, parameters)
+
+    def isCurrent(self, thePath, theStat, needHash=True):
+        """ Check whether the database entry for a file is up to date.
+
+            thePath:  The full path to the file
+            theStat:  A FileStat for the file as it is now
+            needHash: If True, an entry that has no hash is not up to date
+
+            returns:  True if the file is in the database, has the same size, modification
+                      time, inode, and device as when it was recorded, was hashed with
+                      ALGORITHM, and has a hash if one is needed.  False otherwise.
+        """
+        cur = self.con.cursor()
+        cur.execute("select files.hash, files.size, files.mtime_ns, files.inode, files.device "
+                    "from files join dirs on dirs.id = files.dir "
+                    "where dirs.path=? and files.name=? and files.algorithm=?",
+                    splitPath(thePath) + (ALGORITHM, ))
+        records = cur.fetchall()
+        if not records or tuple(records[0][1:]) != tuple(theStat):
+            return False
+        return bool(records[0][0]) or not needHash
+
+    def linkedHash(self, theStat):
+        """ Find the hash of another link to a file.  Hard links share an inode, so
+            a file that has the same device, inode, size and modification time as a
+            file that is already in the database has the same contents
+
+            theStat:  A FileStat for the file
+            returns:  The hash of the file, calculated with ALGORITHM, or None if no
+                      link to the file is in the database
+        """
+        cur = self.con.cursor()
+        cur.execute("select hash from files where device=? and inode=? and size=? and mtime_ns=? "
+                    "and algorithm=? and hash not null limit 1",
+                    (theStat.device, theStat.inode, theStat.size, theStat.mtime_ns, ALGORITHM))
+        records = cur.fetchall()
+        return blobToHash(records[0][0]) if records else None
+
+    def stagedWrite(self, theEntries):
+        """ Write files found by a scan to the database, reading as little of each
+            file as possible
+
+            theEntries: An iterable of (path, FileStat, links) tuples
+            returns:    None
+
+            A file whose size is not shared by any other file in the database cannot be
+            a duplicate, so it is recorded without being read.  Files that share a size
+            are compared by hashing their first and last blocks, and only the files that
+            still collide are fully hashed.  Files already in the database that collide
+            with a new file are brought up to date as well.  Files that are hard links
+            to each other are only read once.
+        """
+        logging.info("Staged scan of new files")
+        cur = self.con.cursor()
+        cur.execute("drop table if exists temp.scan")
+        cur.execute("create temp table scan"
+                    "(path text, dir integer, name text, size integer, mtime_ns integer, inode integer, "
+                    "device integer, partial blob, hash blob, algorithm text, primary key (dir, name))")
+        cur.execute("create temp table if not exists sizes(size integer primary key)")
+        cur.execute("delete from sizes")
+        (entries, paths) = itertools.tee(theEntries)
+        cur.executemany("insert or replace into scan (path, dir, name, size, mtime_ns, inode, device, algorithm) "
+                        "values (?,?,?,?,?,?,?,?)",
+                        ((x[0], ) + key + tuple(x[1]) + (ALGORITHM, )
+                         for (key, x) in zip(self.dirIds(x[0] for x in paths), entries)))
+        others = ("(select dirs.path || '/' || files.name as path, files.* from files "
+                  "join dirs on dirs.id = files.dir where (files.dir, files.name) not in "
+                  "(select dir, name from scan))")
+        both = "(select size, partial from scan union all select size, partial from %s)" % others
+
+        # Files written by older versions have no recorded size.  Record it now so that
+        # they can be matched against the new files
+
+        cur.execute("select dirs.path || '/' || files.name, files.dir, files.name "
+                    "from files join dirs on dirs.id = files.dir where size is null and hash not null")
+        sizes = []
+        for (path, theDir, theName) in cur.fetchall():
+            try:
+                sizes.append(("files", (os.path.getsize(path), theDir, theName)))
+            except OSError:
+                continue
+        self.updateMany("update %s set size=? where dir=? and name=?", sizes)
+
+        # Stage 1: Find the sizes of the new files that are shared by another file.
+        # Files already in the database that share a size only with each other are
+        # left alone, unless one of them has no hash and another has not been compared
+        # with it.  That happens when a plain scan finds a file of the same size as a
+        # file that a staged scan recorded without a hash
+
+        cur.execute("insert into sizes select size from %s where size in (select size from scan) "
+                    "or (size in (select size from %s where hash is null) "
+                    "and size in (select size from %s where partial is null or algorithm is not ?)) "
+                    "group by size having count(*) > 1" % (both, others, others), (ALGORITHM, ))
+
+        # Stage 2: Hash the first and last blocks of each file that shares its size.
+        # Small files are read completely, so that hash is also the full hash.  A hash
+        # that was calculated with another algorithm cannot be compared, so it is dropped.
+        # A file already in the database that has changed since it was recorded is
+        # skipped, as a new partial hash would not match its old hash.  It is brought up
+        # to date when its own tree is scanned
+
+        cur.execute("select path, size, 'scan', dir, name, device, inode, mtime_ns from scan "
+                    "where size in (select size from sizes) "
+                    "union all "
+                    "select path, size, 'files', dir, name, device, inode, mtime_ns from %s "
+                    "where (partial is null or algorithm is not ?) "
+                    "and size in (select size from sizes)" % others, (ALGORITHM, ))
+        candidates = []
+        for x in cur.fetchall():
+            if x[2] == "files" and not isUnchanged(x[0], x[1], x[7]):
+                logging.info("%s has changed since it was scanned", x[0])
+                continue
+            candidates.append(x[:7])
+        partials = mapInodes(PartialHashFile, [x[5:] for x in candidates],
+                             [x[0] for x in candidates], [x[1] for x in candidates])
+        self.updateMany("update %s set hash = coalesce(?, case when algorithm is ? then hash end), "
+                        "partial=?, algorithm=? where dir=? and name=?",
+                        ((table, (partial if size <= 2 * PARTIAL_BLOCKSIZE else None, ALGORITHM,
+                                  partial, ALGORITHM, theDir, theName))
+                         for (path, size, table, theDir, theName, device, inode), partial in
+                         zip(candidates, map(hashToBlob, partials))))
+
+        # Stage 3: Fully hash the files that still collide
+
+        collisions = ("(size, partial) in (select size, partial from %s where partial not null "
+                      "group by size, partial having count(*) > 1)" % both)
+        cur.execute("select path, 'scan', dir, name, device, inode from scan where hash is null and %s "
+                    "union all "
+                    "select path, 'files', dir, name, device, inode from %s where hash is null and %s" %
+                    (collisions, others, collisions))
+        candidates = cur.fetchall()
+        hashes = mapInodes(HashFile, [x[4:] for x in candidates], [x[0] for x in candidates])
+        self.updateMany("update %s set hash=? where dir=? and name=?",
+                        ((table, (hashToBlob(theHash), theDir, theName))
+                         for (path, table, theDir, theName, device, inode), theHash in zip(candidates, hashes)))
+
+        cur.execute("select path, hash, partial, size, mtime_ns, inode, device from scan")
+        self.writeMany((blobToHash(x[1]), x[0], FileStat(*x[3:]), blobToHash(x[2])) for x in cur.fetchall())
 
     def DupCheck(self):
         """Check for duplicate files
@@ -120,27 +693,208 @@ class Database:
            Takes no parameters.
            Returns None
 
-           Walk through all hashes stored in the data base and look for duplicates.
-           If duplicates are found, print the hash and paths to each duplicated file
+           Find the hashes stored in the data base that are shared by more than one
+           file, and print each of them with the paths to the duplicated files, the
+           number of files, and the number of bytes that purging all but one of the
+           files would reclaim, allowing for files that are hard links to each other.
+           The groups are read from the database one at a time, by walking the index
+           of the hashes in order, so nothing is sorted before the first group is
+           printed.  The output format is set by OUTPUT_FORMAT, as for printGroups
         """
         logging.info("Checking for duplicate files in the database")
         cur = self.con.cursor()
-        cur.execute("select * from files order by hash")
-        (old_hash, pathList) = ('', [])
-        for workingRecord in cur.fetchall():
-            logging.debug("Checking hash %s for duplicates", workingRecord[1])
-            if old_hash != workingRecord[1]:
-                # The hash has changed since the the last record, see if there were multiple
-                # records with that hash and print them if there were
-                if len(pathList) > 1:
-                    print("Hash %s"%old_hash)
-                    for y in pathList:
-                        print("  %s"%y)
-                (pathList, old_hash) = ([workingRecord[0]], workingRecord[1])
-            else:
-                # The hash did not change from the last record. Add the path
-                # from this record to the to the list
-                pathList.append(workingRecord[0])
+        cur.execute("select lower(hex(files.hash)), dirs.path || '/' || files.name, files.size, "
+                    "files.algorithm, files.device, files.inode from files "
+                    "join dirs on dirs.id = files.dir "
+                    "where files.hash in (select hash from files where hash not null "
+                    "group by hash having count(*) > 1) order by files.hash")
+        printGroups(cur)
+
+    def dirHashes(self):
+        """ Calculate a hash of the tree of files below every directory, from the hashes
+            of the files in it and of the directories in it, as in a Merkle tree.  Two
+            directories have the same hash if they hold files with the same names and
+            contents, and directories with the same names and trees.
+
+            Takes no parameters
+            returns: A dictionary of (hash, size, files) tuples keyed on the paths of the
+                     directories, where size and files are the total size and number of
+                     the files in the tree.  The hash is None if the tree holds a file
+                     that was not hashed, which a staged scan only leaves if no other file
+                     has its size, so the tree cannot have a duplicate
+
+            The files are read in one pass, in reverse order of the paths of their
+            directories, so every directory is reached after all of the directories
+            below it.  Directories that hold no files themselves are not in dirs.  They
+            are added as the directories below them are finished.  The root directory
+            is "", as in dirs.
+        """
+        (trees, pending) = ({}, {})
+
+        def finish(thePath, theEntries):
+            hasher = hashlib.sha256()
+            (theHash, size, files) = (b"", 0, 0)
+            for (kind, name, entryHash, entrySize, entryFiles) in sorted(theEntries):
+                if entryHash is None:
+                    theHash = None
+                elif theHash is not None:
+                    hasher.update(kind + name.encode("utf-8", "surrogateescape") + b"\0" +
+                                  bytes([len(entryHash)]) + entryHash)
+                (size, files) = (size + (entrySize or 0), files + entryFiles)
+            if theHash is not None:
+                theHash = hasher.digest()
+            trees[thePath] = (theHash, size, files)
+            if thePath:
+                (parent, name) = splitPath(thePath)
+                pending.setdefault(parent, []).append((b"d", name, theHash, size, files))
+
+        cur = self.con.cursor()
+        cur.execute("select dirs.path, files.name, files.hash, files.size from dirs "
+                    "join files on files.dir = dirs.id order by dirs.path desc")
+        for thePath, group in itertools.groupby(cur, key=lambda x: x[0]):
+
+            # Directories that only hold directories are finished when the next
+            # directory is not below them
+
+            while pending and max(pending) > thePath:
+                parent = max(pending)
+                finish(parent, pending.pop(parent))
+            finish(thePath, [(b"f", x[1], x[2], x[3], 1) for x in group] + pending.pop(thePath, []))
+        while pending:
+            parent = max(pending)
+            finish(parent, pending.pop(parent))
+        return trees
+
+    def DupDirs(self):
+        """ Find the directories that hold the same tree of files as another directory,
+            and print each group of them, as DupCheck does, with the largest trees first.
+            The size is the total size of the files in each tree
+
+            Takes no parameters
+            returns: None
+
+            The trees are found by dirHashes.  A group of trees that are each in a
+            different directory of another group, such as the subdirectories of two
+            copies of a directory, is not printed, as the larger group accounts for it.
+        """
+        logging.info("Checking for duplicate directories in the database")
+        trees = self.dirHashes()
+        groups = {}
+        for (thePath, (theHash, size, files)) in trees.items():
+            if theHash is not None and files:
+                groups.setdefault(theHash, []).append(thePath)
+
+        def accounted(theGroup):
+            parents = [splitPath(x)[0] for x in theGroup]
+            hashes = set(trees[x][0] for x in parents if x in trees)
+            return len(set(parents)) == len(parents) and len(hashes) == 1 and None not in hashes and \
+                "" not in theGroup
+
+        groups = [sorted(x) for x in groups.values() if len(x) > 1 and not accounted(x)]
+        groups.sort(key=lambda x: (-trees[x[0]][1], x[0]))
+        logging.info("Found %d groups of duplicate directories", len(groups))
+        printGroups(((trees[x][0].hex(), x or "/", trees[x][1], "tree", None, None)
+                     for group in groups for x in group), "directories")
+
+    def Export(self, theFileName):
+        """ Write the hashes of the files in the database to a shard, a small database
+            that --merge reads to find files that are duplicated on other hosts.  The
+            shard holds the host name, once, and the path, size, device, inode,
+            algorithm and hash of each file, with the hash in binary.  Files that a
+            staged scan recorded without a hash are exported with their size, so that
+            --merge can find those that may have a copy on another host.  A shard that
+            already exists is replaced, in a single transaction, so it is left as it
+            was if the export fails
+
+            theFileName: The name of the shard
+            returns:     None
+        """
+        import socket
+        host = HOST or socket.gethostname()
+        logging.info("Exporting hashes for host %s to %s", host, theFileName)
+        self.con.execute("ATTACH DATABASE ? AS shard", (theFileName, ))
+        try:
+            self.con.execute("BEGIN")
+            with self.con:
+                self.con.execute("DROP TABLE IF EXISTS shard.host")
+                self.con.execute("DROP TABLE IF EXISTS shard.files")
+                self.con.execute("CREATE TABLE shard.host(name TEXT NOT NULL)")
+                self.con.execute("INSERT INTO shard.host VALUES (?)", (host, ))
+                self.con.execute("CREATE TABLE shard.files(path TEXT NOT NULL, size INTEGER, device INTEGER, "
+                                 "inode INTEGER, algorithm TEXT, hash BLOB)")
+                exported = self.con.execute("INSERT INTO shard.files SELECT dirs.path || '/' || files.name, "
+                                            "files.size, files.device, files.inode, files.algorithm, "
+                                            "files.hash FROM main.files JOIN main.dirs ON dirs.id = files.dir "
+                                            "WHERE files.hash NOT NULL OR files.size NOT NULL").rowcount
+                unhashed = self.con.execute("SELECT count(*) FROM shard.files WHERE hash IS NULL").fetchone()[0]
+        finally:
+            self.con.execute("DETACH DATABASE shard")
+        logging.info("Exported %d files, %d of them without a hash", exported, unhashed)
+
+    def Merge(self, theFileNames):
+        """ Find files that are duplicated on different hosts, from the shards written
+            by Export on each host.  Only the shards are read.  Each group of files with
+            the same hash is printed, as by DupCheck, if the files are on more than one
+            host.  Paths are shown as host:path.  Files that have no hash, but have the
+            same size as a file on another host, are reported, as they can only be
+            compared once they are hashed on their own host
+
+            theFileNames: A list of the names of the shards
+            returns:      None
+
+            The shards are copied, one at a time, into a temporary table, so that any
+            number of them can be merged, and the groups are found by joining that
+            table with its duplicated hashes on an index of the hash.
+        """
+        cur = self.con.cursor()
+        cur.execute("DROP TABLE IF EXISTS temp.merged")
+        cur.execute("CREATE TEMP TABLE merged(host TEXT, path TEXT, size INTEGER, "
+                    "device INTEGER, inode INTEGER, algorithm TEXT, hash BLOB)")
+        for theFileName in theFileNames:
+            if not os.path.isfile(theFileName):
+                logging.error("Unable to read hashes from %s: no such file", theFileName)
+                continue
+            cur.execute("ATTACH DATABASE ? AS shard", (theFileName, ))
+            try:
+                cur.execute("SELECT name FROM shard.host")
+                host = cur.fetchone()
+                if host is None:
+                    logging.error("Unable to read hashes from %s: no host name", theFileName)
+                    continue
+                host = host[0]
+                logging.info("Reading hashes for host %s from %s", host, theFileName)
+                with self.con:
+                    cur.execute("INSERT INTO merged SELECT ?, path, size, device, inode, algorithm, hash "
+                                "FROM shard.files", (host, ))
+            except sqlite3.DatabaseError as e:
+                logging.error("Unable to read hashes from %s: %s", theFileName, e)
+            finally:
+                cur.execute("DETACH DATABASE shard")
+        cur.execute("CREATE INDEX temp.merged_hash ON merged(algorithm, hash)")
+        cur.execute("select lower(hex(merged.hash)), merged.host || ':' || merged.path, merged.size, "
+                    "merged.algorithm, merged.host || ':' || merged.device, merged.inode "
+                    "from merged join "
+                    "(select algorithm, hash from merged where hash not null "
+                    "group by algorithm, hash "
+                    "having count(distinct host) > 1) as duplicates "
+                    "on merged.algorithm = duplicates.algorithm and merged.hash = duplicates.hash "
+                    "order by merged.algorithm, merged.hash")
+        printGroups(cur)
+
+        cur.execute("CREATE INDEX temp.merged_size ON merged(size)")
+        cur.execute("select merged.host || ':' || merged.path from merged join "
+                    "(select size from merged where size not null group by size "
+                    "having count(distinct host) > 1 and count(hash) < count(*)) as collisions "
+                    "on merged.size = collisions.size where merged.hash is null "
+                    "order by merged.host, merged.path")
+        unhashed = [x[0] for x in cur.fetchall()]
+        if unhashed:
+            logging.warning("%d files have no hash, but have the same size as a file on another host.  "
+                            "Scan them again without --staged on their own host, and export again, "
+                            "to compare them", len(unhashed))
+            for thePath in unhashed:
+                logging.info("Not hashed: %s", thePath)
+        cur.execute("DROP TABLE merged")
 
     def Integrity(self):
         """ Check the integrity of all the files in the database
@@ -148,27 +902,120 @@ class Database:
             Takes no parameters
             Returns: None
 
-            Walk through all the paths stored in the database, recalcualte each hash,
-            and check that the recalculated hash is the same is the stored value
+            Walk through all the paths stored in the database in order, and check that
+            each file still exists and still matches what is recorded for it.  How much
+            is checked depends on VERIFY:
+
+              stat:   Compare the size and modification time of each file with the
+                      recorded values.  No files are read
+              sample: As for stat, and also recalculate the hash of each file that
+                      has changed, and of SAMPLE percent of the others, chosen at random
+              full:   Recalculate the hash of every file, using JOBS threads
+
+            Files are checked in batches, in the order of their keys.  Changes are written
+            to the database, and the key of the last file checked is recorded, at the end
+            of each batch, so that a check that is interrupted can be continued with RESUME.
         """
-        logging.info("Checking database integrity")
+        logging.info("Checking database integrity (%s)", VERIFY)
         cur = self.con.cursor()
-        cur.execute("select * from files order by path")
-        for workingRecord in cur.fetchall():
-            logging.debug("Checking file %s for duplicates", workingRecord[0])
-            if os.path.isfile(workingRecord[0]):
-                hash = HashFile(workingRecord[0])
-                if workingRecord[1] != hash:
-                    print("File %s changed.\n  Old hash:%s\n  New hash:%s"%
-                          (workingRecord[0], workingRecord[1], hash))
-                    if not DRY_RUN:
-                        cur.execute("update files set hash=? where path=?",
-                                    (hash, workingRecord[0]))
-            else:
-                logging.warning("File %s no longer exists", workingRecord[0])
+        position = (0, "")
+        if RESUME:
+            cur.execute("select position from checkpoints where task='check'")
+            records = cur.fetchall()
+            if records:
+                (theDir, theName, thePath) = json.loads(records[0][0])
+                position = (theDir, theName)
+                logging.warning("Resuming integrity check after %s", thePath)
+        if STATS.enabled:
+            cur.execute("select count(*) from files where (dir, name) > (?, ?)", position)
+            STATS.expect(cur.fetchone()[0], "files_checked")
+        (checked, changed, missing) = (0, 0, 0)
+        while True:
+            cur.execute("select dirs.path || '/' || files.name, files.hash, files.size, files.mtime_ns, "
+                        "files.algorithm, files.dir, files.name from files join dirs on dirs.id = files.dir "
+                        "where (files.dir, files.name) > (?, ?) order by files.dir, files.name limit ?",
+                        position + (BATCHSIZE, ))
+            records = cur.fetchall()
+            if not records:
+                break
+            keys = dict((x[0], x[5:]) for x in records)
+            (updates, removals) = self.checkFiles([(x[0], blobToHash(x[1])) + x[2:5] for x in records])
+            (checked, changed, missing) = (checked + len(records), changed + len(updates),
+                                           missing + len(removals))
+            position = records[-1][5:]
+            start = time.perf_counter()
+            with self.con:
                 if not DRY_RUN:
-                    cur.execute("delete from files where path=?", (workingRecord[0], ))
+                    self.con.executemany("update files set hash=?, partial=?, size=?, mtime_ns=?, "
+                                         "inode=?, device=? where dir=? and name=?",
+                                         ((hashToBlob(x[0]), hashToBlob(x[1])) + x[2:6] + keys[x[6]]
+                                          for x in updates))
+                    self.con.executemany("delete from files where dir=? and name=?",
+                                         (keys[x[0]] for x in removals))
+                self.con.execute("insert or replace into checkpoints values ('check', ?)",
+                                 (json.dumps(position + (records[-1][0], )), ))
+            STATS.addTime("database", time.perf_counter() - start)
+            STATS.count("files_checked", len(records))
+        with self.con:
+            self.con.execute("delete from checkpoints where task='check'")
+            if not DRY_RUN:
+                self.pruneDirs()
+        logging.info("Checked %d files.  %d changed, %d no longer exist", checked, changed, missing)
+
+    def checkFiles(self, theRecords):
+        """ Check one batch of files for Integrity
+
+            theRecords: A list of (path, hash, size, mtime_ns, algorithm) tuples from the
+                        files table
+            returns:    A tuple of two lists.  The first holds (hash, partial, size,
+                        mtime_ns, inode, device, path) tuples for files whose database
+                        entry needs to be updated, and the second holds (path, ) tuples
+                        for files that no longer exist
+        """
+        (updates, removals, toHash) = ([], [], [])
+        for (path, oldHash, oldSize, oldMtime, algorithm) in theRecords:
+            logging.debug("Checking file %s", path)
+            try:
+                theStat = os.stat(path)
+            except OSError:
+                theStat = None
+            if theStat is None or not stat.S_ISREG(theStat.st_mode):
+                logging.warning("File %s no longer exists", path)
+                removals.append((path, ))
+                continue
+            theStat = fileStat(theStat)
+            drifted = (oldSize, oldMtime) != (theStat.size, theStat.mtime_ns)
 
+            # Files of unique size found by a staged scan were never hashed.  Check their size
+
+            if oldHash is None:
+                if drifted:
+                    if oldSize != theStat.size:
+                        print("File %s changed.\n  Old size:%s\n  New size:%s"%
+                              (path, oldSize, theStat.size))
+                    updates.append((None, None) + theStat + (path, ))
+                continue
+            if VERIFY == "stat" or (VERIFY == "sample" and not drifted and
+                                    random.random() * 100 >= SAMPLE):
+                if drifted:
+                    print("File %s changed.\n  Old size:%s  Old mtime_ns:%s\n  New size:%s  New mtime_ns:%s"%
+                          (path, oldSize, oldMtime, theStat.size, theStat.mtime_ns))
+                continue
+            if (algorithm or ALGORITHM) not in hashAlgorithms:
+                logging.warning("Unable to check %s.  It was hashed with %s, which is not available",
+                                path, algorithm)
+                continue
+            toHash.append((path, oldHash, theStat, drifted, algorithm))
+
+        hashes = mapFiles(HashFile, [x[0] for x in toHash], [x[4] for x in toHash])
+        for (path, oldHash, theStat, drifted, algorithm), hash in zip(toHash, hashes):
+            if oldHash != hash:
+                print("File %s changed.\n  Old hash:%s\n  New hash:%s"%
+                      (path, oldHash, hash))
+                updates.append((hash, None) + theStat + (path, ))
+            elif drifted:
+                updates.append((hash, None) + theStat + (path, ))
+        return (updates, removals)
 
     def Purge(self, thePath):
         """ Purge duplicate files from the database and the file system
@@ -176,187 +1023,438 @@ class Database:
             thePath: The full or partial path to the duplicate file(s) to be purged
             returns: None
 
-            Walk through all of the file names in the database that "match" thePath.
-            "match" means that full path name to the file starts with thePath.  For each
-            file, it checks if it still exists and that its hash has not changed ,
-            then checks to see if there are any other files in the database with the
-            same hash.  It then checks those files still exist and that their hashes
-            are accurate, and that they are not symlinks.  If all of these conditions
-            are met, the file will be deleted and will be removed from the database.
+            Find all of the file names in the database that "match" thePath.  "match"
+            means that the file is thePath, or is in the directory given by thePath, or,
+            with SUBTREE, is anywhere below that directory.  The matching files are
+            grouped with all of the other files in the database that have the same
+            hash.  Every member of
+            a group must still exist and must not be a symlink.  If any member of a group
+            fails these checks, nothing in the group is purged.  A matching file that has
+            a duplicate in its own directory is not purged either, nor is one that is the
+            same file, by device and inode, as a file that is kept.  Every other matching
+            file is purged, if verifyGroup finds that it is still identical to one of the
+            remaining members of its group, which are kept.
+
+            Only files that have a duplicate outside the matching files are purged, so
+            with SUBTREE, a whole duplicated tree, as found by DupDirs, can be purged
+            when its copy is elsewhere.  The directories below thePath that are left
+            empty are removed, but thePath itself is kept.
+
+            If LINK_MODE is set, a purged file is not deleted.  It is replaced with a hard
+            link ("hard") or a copy on write clone ("reflink") of one of the kept files on
+            the same file system, and its database entry is updated.
+
+            The plan is printed, then all of the files in it are deleted, or replaced
+            with links, and the database updated in a single transaction.
         """
         theRealPath = os.path.abspath(thePath)
-        logging.info("Purging duplicate files starting with %s", theRealPath)
-        cur = self.con.cursor()
-        cur.execute("PRAGMA case_sensitive_like=ON;")
-        cur.execute("select * from files where path like ?", (theRealPath+'%', ))
-
-        for workingRecord in cur.fetchall():
+        logging.info("Purging duplicate files in %s", theRealPath)
 
-            # If the file we are looking for is not explicit, and is not in the specified
-            # directory, DO NOT delete it
+        # If the file we are looking for is not explicit, and is not in the specified
+        # directory, DO NOT delete it
 
-            if not sameDir(theRealPath, workingRecord[0]):
-                logging.debug("%s is not in the target directory", workingRecord[0])
-                continue
-            logging.info("Checking if file %s can be purged", workingRecord[0])
-
-            # If any files are stale, DO NOT delete the file
-
-            cur2 = self.con.cursor()
-            cur2.execute("select * from files where hash=?", (workingRecord[1], ))
-            die, duplicates = False, cur2.fetchall()
-            logging.info("Checking all matching hashes to ensure they have not changed")
-            for x in duplicates:
-                if os.path.islink(x[0]):
-                    logging.warning("Refusing to process linked file %s", x[0])
-                    die = True
-                logging.debug("Checking hash for %s", x[0])
-                theHash = HashFile(x[0])
-                if not theHash or x[1] != theHash:
-                    logging.warning("Refusing to purge %s (Hash changed)", x[0])
-                    die = True
-            if die: continue
+        if SUBTREE:
+            (condition, parameters) = pathRange(theRealPath)
+        else:
+            condition = ("(files.dir = (select id from dirs where path = ?) or "
+                         "(files.dir = (select id from dirs where path = ?) and files.name = ?))")
+            parameters = (theRealPath.rstrip("/"), ) + splitPath(theRealPath)
+        cur = self.con.cursor()
+        cur.execute("select files.hash, dirs.path || '/' || files.name, files.size, files.dir, "
+                    "files.name, %s from files join "
+                    "(select distinct hash from files where %s and hash not null) as candidates "
+                    "on files.hash = candidates.hash join dirs on dirs.id = files.dir "
+                    "order by files.hash" % (condition, condition), parameters + parameters)
+
+        plan = []
+        for theHash, group in itertools.groupby(cur, key=lambda x: x[0]):
+            group = list(group)
+            sizes = dict((x[1], x[2]) for x in group)
+            keys = dict((x[1], x[3:5]) for x in group)
+            candidates = [x[1] for x in group if x[5]]
+            group = [x[1] for x in group]
 
             # If there is only one file with the hash, it is not a duplicate -- DO NOT delete
 
-            if len(duplicates) < 2:
-                logging.info("  %s is not a duplicate", workingRecord[0])
+            if len(group) < 2:
+                logging.info("  %s is not a duplicate", candidates[0])
+                continue
+            logging.info("Checking if %s can be purged", ", ".join(candidates))
+            candidateSet = set(candidates)
+            kept = [x for x in group if x not in candidateSet]
+
+            # Let's not delete a file if it is in the same directory as one of its duplicates
+
+            dirCounts = Counter(keys[x][0] for x in group)
+            purgeable = []
+            for x in candidates:
+                logging.debug("checking if %s has a duplicate in the same directory", x)
+                if dirCounts[keys[x][0]] != 1:
+                    logging.warning("Refusing to purge %s (Duplicate of file in same directory)", x)
+                    continue
+                purgeable.append(x)
+            if not purgeable:
                 continue
 
-            # If we are here, there are duplicates.  Let's not delete this file if it is in the
-            # same directory as is its
-
-            cur2.execute("select * from files where hash=?", (workingRecord[1],))
-            count = 0
-            for x in cur2.fetchall():
-                logging.debug("checking if %s and %s are in the same directory",
-                              workingRecord[0], x[0])
-                if sameDir(workingRecord[0], x[0]):
-                    logging.debug("Yes")
-                    count += 1
-            if count != 1:
-                logging.warning("Refusing to purge %s (Duplicate of file in same directory)",
-                                workingRecord[0])
+            # If any files in the group are stale or are links, DO NOT delete anything in it.
+            # A file that is linked to must be identical too
+
+            logging.info("Checking that the files have not changed")
+            verified = self.verifyGroup(theHash, group, sizes, kept,
+                                        purgeable + kept if LINK_MODE else purgeable)
+            if verified is None:
                 continue
+            (stats, identical) = verified
+
+            # The first kept file of each inode, and the first kept file that is
+            # identical on each file system, which a purged file is linked to
+
+            keptInodes = {}
+            linkTargets = {}
+            for y in kept:
+                keptInodes.setdefault((stats[y].st_dev, stats[y].st_ino), y)
+                if y in identical:
+                    linkTargets.setdefault(stats[y].st_dev, y)
+            for x in purgeable:
+                if x not in identical:
+                    logging.warning("Refusing to purge %s (Not identical to the duplicate that is kept)", x)
+                    continue
+
+                # It is the same file as one that is kept, as a hard link, or by another path
+                # through a symlinked directory.  Deleting it frees nothing, and in the second
+                # case it deletes the only copy.  DO NOT delete it
 
-            # it is a duplicate.  It has not changed. Its duplicates have not changed. It is
-            # not a duplicate of something in the same directory.  it is not a symlink.
-            # So, delete it
+                link = keptInodes.get((stats[x].st_dev, stats[x].st_ino))
+                if link:
+                    if LINK_MODE:
+                        logging.info("%s is already linked to %s", x, link)
+                    else:
+                        logging.warning("Refusing to purge %s (Same file as %s, which is kept)", x, link)
+                    continue
+
+                # it is a duplicate.  It is still identical to a file that is kept. It is
+                # not a duplicate of something in the same directory.  it is not a symlink.
+                # It is not the file that is kept.  So, plan to delete it
+
+                if LINK_MODE:
+                    target = linkTargets.get(stats[x].st_dev)
+                    if not target:
+                        logging.warning("Refusing to link %s (No duplicate on the same file system)", x)
+                    else:
+                        print("Linking file: %s to %s" % (x, target))
+                        plan.append((x, stats[x].st_size, target, keys[x]))
+                    continue
+                print("Purging file: %s"%x)
+                plan.append((x, stats[x].st_size, None, keys[x]))
 
-            print("Purging file: %s"%workingRecord[0])
+        print("Purge plan: %d files, %d bytes reclaimed" % (len(plan), sum(x[1] for x in plan)))
 
-            # Last chance -- If this is a dry run, do not delete this
+        # Last chance -- If this is a dry run, do not delete anything
 
-            if DRY_RUN:
+        if DRY_RUN:
+            if plan:
                 logging.warning("... Just kidding, this is a dry run")
+            return
+        with self.con:
+            (removed, linked) = ([], [])
+            for (x, size, target, key) in plan:
+                try:
+                    if target:
+                        LinkFile(x, target, LINK_MODE)
+                        linked.append(fileStat(os.stat(x)) + key)
+                    else:
+                        os.remove(x)
+                        removed.append(key)
+                except OSError as e:
+                    logging.warning("Unable to purge %s: %s", x, e)
+            self.con.executemany("delete from files where dir=? and name=?", removed)
+            self.con.executemany("update files set size=?, mtime_ns=?, inode=?, device=? "
+                                 "where dir=? and name=?", linked)
+            self.pruneDirs(theRealPath)
+
+        # Remove the directories below thePath that the purge emptied, from the bottom
+        # up.  A directory that still holds anything is not removed, and neither is
+        # thePath
+
+        if SUBTREE:
+            base = theRealPath.rstrip("/")
+            for directory in sorted(set(os.path.dirname(x[0]) for x in plan if not x[2]), reverse=True):
+                while directory.startswith(base + "/"):
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        break
+                    logging.info("Removed empty directory %s", directory)
+                    directory = os.path.dirname(directory)
+
+    def verifyGroup(self, theHash, theGroup, theSizes, theReferences, theFiles):
+        """ Check that files that are recorded with the same hash are still duplicates,
+            by comparing them with a file that will be kept
+
+            theHash:       The hash recorded for the files
+            theGroup:      A list of the full paths to all of the files with the hash
+            theSizes:      A dictionary of the recorded size of each file
+            theReferences: The files in theGroup that will be kept.  The first of them
+                           that still has its recorded size is the reference
+            theFiles:      The files in theGroup to compare with the reference
+            returns:  A tuple of a dictionary of the os.stat results for the files in
+                      theGroup, keyed on their paths, and a set of the files that are
+                      identical to the reference, including the reference.  None if any
+                      file no longer exists or is a symlink, or if there is no reference
+
+            A file whose size has changed is ruled out without being read.  The others
+            are compared with the reference by compareFiles, which reads each of them
+            once, and stops at the first difference, so no file is hashed.  Files that
+            are hard links to the reference are not read.  Neither are files that were
+            found to be identical to the reference earlier in the run, if the size,
+            modification time and change time of both are still the same.  A file that
+            changes while it is being compared is not identical.
+        """
+        stats = {}
+        for x in theGroup:
+            if os.path.islink(x):
+                logging.warning("Refusing to process linked file %s", x)
+                return None
+            try:
+                stats[x] = os.stat(x)
+            except OSError:
+                logging.warning("Refusing to purge %s (File no longer exists)", x)
+                return None
+        sized = set(x for x in theGroup if stats[x].st_size == theSizes[x] or theSizes[x] is None)
+        for x in theGroup:
+            if x not in sized:
+                logging.info("%s has changed size", x)
+        references = [x for x in theReferences if x in sized]
+        if not references:
+            logging.warning("Refusing to purge %s (No unchanged duplicate)", ", ".join(theFiles))
+            return None
+        reference = references[0]
+
+        # verified holds the snapshots of files that were identical when they were compared,
+        # so a file whose snapshot is unchanged is still identical to the others
+
+        def snapshot(theStat):
+            return (theStat.st_dev, theStat.st_ino, theStat.st_size, theStat.st_mtime_ns, theStat.st_ctime_ns)
+        verified = self.verified.get(theHash, set())
+        if snapshot(stats[reference]) not in verified:
+            verified = set()
+        identical = set([reference])
+        toCompare = []
+        for x in theFiles:
+            if x not in sized or x == reference:
                 continue
+            if sameInode(stats[x], stats[reference]) or snapshot(stats[x]) in verified:
+                identical.add(x)
             else:
-                cur.execute("delete from files where path=?", (workingRecord[0], ))
-                os.remove(workingRecord[0])
+                toCompare.append(x)
+
+        # Files that are hard links to each other are only compared once
+
+        inodes = {}
+        for x in toCompare:
+            inodes.setdefault((stats[x].st_dev, stats[x].st_ino), []).append(x)
+        logging.debug("Comparing %d files with %s", len(inodes), reference)
+        matched = compareFiles(reference, [x[0] for x in inodes.values()])
+        for x in matched:
+            identical.update(inodes[(stats[x].st_dev, stats[x].st_ino)])
+
+        # The files must not have changed while they were compared
+
+        for x in list(identical):
+            try:
+                changed = snapshot(os.stat(x)) != snapshot(stats[x])
+            except OSError:
+                changed = True
+            if changed:
+                logging.info("%s changed while it was compared", x)
+                if x == reference:
+                    return (stats, set())
+                identical.discard(x)
+        self.verified[theHash] = verified | set(snapshot(stats[x]) for x in identical)
+        return (stats, identical)
 
     def Remove(self, thePath):
         """ Remove files from the database in a given path.  No files are removed from the filesystem
 
-            thePath:  A string that specifies the full or partial path of files to remove
-                     from the database.
+            thePath:  A string that specifies the full path of a file, or of a directory
+                     whose files are to be removed from the database.
 
             Returns: None
+
+            The files are removed with a single DELETE.  In a dry run, the files that
+            would be removed are listed instead, as they are found.
         """
         theRealPath = os.path.abspath(thePath)
-        logging.info("Removing entries starting with %s", theRealPath)
-        cur = self.con.cursor()
-        cur.execute("PRAGMA case_sensitive_like=ON;")
-        cur.execute("select * from files where path like ?", (theRealPath+'%', ))
+        logging.info("Removing entries in %s", theRealPath)
+        (condition, parameters) = pathRange(theRealPath)
+        if DRY_RUN:
+            cur = self.con.cursor()
+            cur.execute("select dirs.path || '/' || files.name from files join dirs on dirs.id = files.dir "
+                        "where %s order by dirs.path, files.name" % condition, parameters)
+            for (thePath, ) in cur:
+                print("Removing %s from the database"%thePath)
+            logging.warning("... Just kidding, this is a dry run")
+            return
+        with self.con:
+            removed = self.con.execute("delete from files where %s" % condition, parameters).rowcount
+            self.pruneDirs(theRealPath)
+        print("Removed %d files from the database" % removed)
 
-        for workingRecord in cur.fetchall():
+    def removePath(self, thePath):
+        """ Remove a file, or a directory and all of the files in it, from the database.
+            No files are removed from the filesystem
 
-            # If the file we are looking for is not explicit, and is not in the specified
-            # directory, DO NOT delete it
+            thePath: The full path of the file or directory
+            returns: None
+        """
+        (condition, parameters) = pathRange(thePath)
+        with self.con:
+            self.con.execute("delete from files where %s" % condition, parameters)
+            self.pruneDirs(thePath)
 
-            print("Removing %s from the database"%workingRecord[0])
-            if DRY_RUN:
-                logging.warning("... Just kidding, this is a dry run")
-                continue
-            else:
-                cur.execute("delete from files where path=?", (workingRecord[0], ))
+    def movePath(self, theOldPath, theNewPath):
+        """ Record that a file, or a directory and all of the files in it, has been
+            renamed.  Anything that was recorded at the new path is replaced
+
+            theOldPath: The full path the file or directory had
+            theNewPath: The full path it has now
+            returns:    None
+
+            A file is moved to the directory of its new path.  A directory is renamed
+            in dirs, as are all of the directories below it, so the files in them are
+            not touched.
+        """
+        (newCondition, newParameters) = pathRange(theNewPath)
+        (oldCondition, oldParameters) = dirRange(theOldPath)
+        (oldBase, newBase) = (theOldPath.rstrip("/"), theNewPath.rstrip("/"))
+        with self.con:
+            self.con.execute("delete from files where %s" % newCondition, newParameters)
+            self.pruneDirs(theNewPath)
+            cur = self.con.execute("select files.dir, files.name from files join dirs on dirs.id = files.dir "
+                                   "where dirs.path = ? and files.name = ?", splitPath(theOldPath))
+            if cur.fetchall():
+                self.con.execute("update files set dir=?, name=? where dir=(select id from dirs where path=?) "
+                                 "and name=?", next(self.dirIds([theNewPath])) + splitPath(theOldPath))
+            self.con.execute("update dirs set path = ? || substr(path, ?) where %s" % oldCondition,
+                             (newBase, len(oldBase) + 1) + oldParameters)
 
     def getExif(self):
-        """ Process all of the hashed in the data base and attempt to read interesting
-            exif data from those files.  Interesting, for now, means geolocation and the
-            time that the photo was taken.  This depends on the GExiv2 module.  If the 
-            program had been unable to load that module, this method will gracefully exit
-       
+        """ Read interesting exif data from one file for each hash in the database that
+            has no metadata yet.  Interesting, for now, means geolocation and the time
+            that the photo was taken.  This depends on the GExiv2 module.  If the program
+            had been unable to load that module, this method will gracefully exit
+
+            Only files that look like images, by their extension or by their first bytes,
+            are read.  They are read by JOBS worker processes, so a file that crashes
+            GExiv2 only loses that file.  A row is written for every hash that is
+            examined, even if no exif data was found, so it is not examined again.  With
+            REHASH, every hash is examined again.
+
             returns: None.
         """
-        if not exifAvailable:
+        if not loadExif():
             logging.warning("Exif operations not available. Is GExiv2 installed?")
             return
-        logging.info("Obtaining exif data for all hashes in the database")
-        cur = self.con.cursor()
-        cur.execute("select * from files order by hash")
-        (old_hash, pathList) = ('', [])
-        for workingRecord in cur.fetchall():
-            if old_hash != workingRecord[1]:
-                
-                # I had many problems with bad avi files causing segfaults
-                # They are not that interesting anyway, so ignore them.
-
-                if workingRecord[0][-4:].lower()==".avi":
-                    logging.warn("Refusing to process %s",workingRecord[0])
-                    continue
-                logging.debug("Getting exif data for  %s"% workingRecord[0])
-                try:
-                    exif=GExiv2.Metadata(workingRecord[0])
-                    if not exif:
-                        logging.warning("EXIF data not available")
-                except:
-                    logging.warning("Unable to read image data for %s"%workingRecord[0])
-                    exif=None
-                if exif:
-                    for tag in [ ("dateTime",'get_date_time'),
-                                 ("latitude",'get_gps_latitude'),
-                                 ("longitude",'get_gps_longitude'),
-                                 ("altitude",'get_gps_altitude'),
-                               ]:
-                        try:
-                            theData=getattr(exif,tag[1])()
-                            cur = self.con.cursor()
-                            cur.execute("select * from metadata where hash=:p", {"p":workingRecord[1]})
-                            matchingRecords = cur.fetchall()
-                            if len(matchingRecords) == 0:
-                                logging.debug("Writing %s: %s=%s to the database", workingRecord[0],tag[0],theData)
-                                cur.execute("insert into metadata (hash, %s) values ( :hash, :data );"%tag[0],
-                                            { 'hash':workingRecord[1], 'data':theData})
-                            else:
-                                if len(matchingRecords) > 1:
-                                    logging.warning("Santity check failure.  Multiple database enties for %s",
-                                                    thePath)
-                                logging.info("Updating %s %s to  %s ",workingRecord[0],tag[0], theData)
-                                cur.execute("update metadata set %s = :data where hash= :hash"%tag[0],
-                                            {'data':theData, 'hash':workingRecord[1]})
-                        except KeyError:
-                            logging.info("File %s has no tag %s",workingRecord[0],tag[1])
-                        except ValueError:
-                            logging.warning("File %s: Cannot decode %s",workingRecord[0],tag[1])
-                old_hash= workingRecord[1]
-
-    def byDate(self, theDate):
+        logging.info("Obtaining exif data for new hashes in the database")
+        batch = []
+
+        def candidates():
+
+            # Page through the hashes, so that the metadata written as we go does not
+            # change a query that is still being read
+
+            cur = self.con.cursor()
+            position = b""
+            while True:
+                cur.execute("select files.hash, min(dirs.path || '/' || files.name) "
+                            "from files join dirs on dirs.id = files.dir where files.hash > ? "
+                            "and (? or files.hash not in (select hash from metadata)) "
+                            "group by files.hash order by files.hash limit ?",
+                            (position, bool(REHASH), BATCHSIZE))
+                records = cur.fetchall()
+                if not records:
+                    return
+                position = records[-1][0]
+                for (theHash, thePath) in records:
+                    try:
+                        if isImage(thePath):
+                            yield (theHash, thePath)
+                        else:
+                            batch.append((theHash, None, None, None, None))
+                    except OSError:
+                        logging.warning("File %s no longer exists", thePath)
+                if len(batch) >= BATCHSIZE:
+                    self.writeExif(batch)
+                    batch.clear()
+
+        lastCommit = time.monotonic()
+        for ((theHash, thePath), record, error) in mapIsolated(ReadExif, candidates(), JOBS):
+            if error:
+                logging.warning("Unable to read image data for %s: %s", thePath, error)
+                record = (theHash, None, None, None, None)
+            batch.append(record)
+            if len(batch) >= BATCHSIZE or time.monotonic() - lastCommit >= COMMIT_INTERVAL:
+                self.writeExif(batch)
+                batch.clear()
+                lastCommit = time.monotonic()
+        self.writeExif(batch)
+
+    def writeExif(self, theBatch):
+        """ Write and commit one batch of exif data for getExif
+
+            theBatch: A list of (hash, dateTime, latitude, longitude, altitude) tuples
+            returns:  None
+        """
+        with self.con:
+            self.con.executemany("insert into metadata "
+                                 "(hash, dateTime, latitude, longitude, altitude) values (?,?,?,?,?) "
+                                 "on conflict(hash) do update set dateTime = excluded.dateTime, "
+                                 "latitude = excluded.latitude, longitude = excluded.longitude, "
+                                 "altitude = excluded.altitude",
+                                 theBatch)
+
+    def byDate(self, theSince=None, theUntil=None):
         """ Output the paths to the files, in chronological order, to stdout.  The files start at the date passed
-            into the function.
+            into the function.  Only the first LIMIT files are output if LIMIT is set, and only one
+            file for each hash if UNIQUE is set
 
-            theDate:  A string that is in "YYYY-MM-DD HH:MM:SS" format.  Tags older than this are not output
+            theSince: A string that is in "YYYY-MM-DD HH:MM:SS" format, or the start of one, such as
+                      "YYYY-MM".  Tags older than this are not output
+            theUntil: As theSince.  Tags newer than this are not output.  A shorter string includes
+                      all of the period it names, so "2020" includes all of 2020
 
             returns: None
         """
+        for (theDateTime, thePath) in self.filesByDate(theSince, theUntil, LIMIT, UNIQUE):
+            print (thePath)
+
+    def filesByDate(self, theSince=None, theUntil=None, theLimit=None, theUnique=False):
+        """ Find the files taken in a period, in chronological order.  The files are read
+            in order from the index on dateTime, so the first are returned at once, and
+            memory use does not depend on the number of files
+
+            theSince:  As for byDate, or None for no lower limit
+            theUntil:  As for byDate, or None for no upper limit
+            theLimit:  If given, the number of files to return
+            theUnique: If True, return one file for each hash
+
+            returns: A generator of (dateTime, path) tuples
+        """
+
+        # "~" sorts after the digits and separators, so it includes everything that
+        # starts with theUntil
+
         cur = self.con.cursor()
-        cur.execute("select datetime, path from metadata, files "
-                    "where files.hash = metadata.hash "
-                    "and datetime not null "
-                    "and datetime > ? "
-                    "order by datetime;",
-                    (theDate,))
-        for record in cur.fetchall():
-            print (record[1])
+        cur.execute("select metadata.dateTime, metadata.hash, dirs.path || '/' || files.name from metadata "
+                    "join files on files.hash = metadata.hash join dirs on dirs.id = files.dir "
+                    "where metadata.dateTime >= ? and metadata.dateTime <= ? "
+                    "order by metadata.dateTime, metadata.hash",
+                    (theSince or "", (theUntil or "9999") + "~"))
+        records = (x for x in cur if x[0])
+        if theUnique:
+            records = (next(group) for (key, group) in itertools.groupby(records, lambda x: x[1]))
+        for (theDateTime, theHash, thePath) in itertools.islice(records, theLimit):
+            yield (theDateTime, thePath)
 
     def lat(self, theLatitude):
         """ Stores the given latitude to a class variable
@@ -370,45 +1468,89 @@ class Database:
     def long(self, theLongitude):
         """ Stores the given longitude to a class variable, then output the 
             file names associated with the unique hashes in order of geolocation
-            from the specified lat,long
+            from the specified lat,long.  Only the nearest LIMIT files, and only
+            files within RADIUS km, are output if those are set
 
             theLocation:  A string that represents the float value of the latitude 
 
             returns: None
         """
         self.longitude=float(theLongitude)
-        if not self.latitude:
+        if self.latitude is None:
             logging.warning("Geolocation requires both latitude and longitude.  Missing latitude")
             return
         logging.info("Geolocation sorted by distance from lat=%s,long=%s",self.latitude,self.longitude)
+        for (theDistance, thePath) in self.nearest(self.latitude, self.longitude, LIMIT, RADIUS):
+            logging.debug("   --> distance=%f km", theDistance)
+            print ("%s"%(thePath))
+
+    def nearest(self, theLatitude, theLongitude, theLimit=None, theRadius=None):
+        """ Find the files nearest to a location
+
+            theLatitude:  The latitude of the location, in degrees
+            theLongitude: The longitude of the location, in degrees
+            theLimit:     If given, the number of files to return
+            theRadius:    If given, only return files within this many km
+
+            returns: A list of (distance in km, path) tuples, nearest first
+
+            Candidates are found with the spatial index, in a bounding box around a
+            circle of theRadius km.  With only theLimit, the circle starts small and
+            grows until it holds theLimit files, so only the files near the location
+            are read.  The exact distances of the candidates are then calculated,
+            and the nearest are kept with a heap.
+        """
+        radius = theRadius if theRadius is not None else (10.0 if theLimit else EARTH_RADIUS * math.pi)
+        while True:
+            candidates = []
+            for (Latitude, Longitude, thePath) in self.locatedFiles(
+                    boundingBoxes(theLatitude, theLongitude, radius)):
+                d = distance(theLatitude, theLongitude, Latitude, Longitude)
+                if d <= radius:
+                    candidates.append((d, thePath))
+
+            # The files within the circle are the nearest files.  If there are not
+            # enough of them, look further
+
+            if theRadius is not None or radius >= EARTH_RADIUS * math.pi or len(candidates) >= theLimit:
+                break
+            radius *= 4
+        if theLimit:
+            return heapq.nsmallest(theLimit, candidates)
+        candidates.sort()
+        return candidates
+
+    def locatedFiles(self, theBoxes):
+        """ Find the files whose location is in any of a list of boxes, using the
+            spatial index
+
+            theBoxes: A list of (minimum latitude, maximum latitude, minimum longitude,
+                      maximum longitude) tuples, as returned by boundingBoxes
+            returns:  A generator of (latitude, longitude, path) tuples
+        """
         cur = self.con.cursor()
-        cur.execute("select latitude, longitude, path from metadata, files "
-                    "where files.hash = metadata.hash "
-                    "and latitude not null "
-                    "and longitude not null "
-                    )
-
-        theList=[]
-        for record in cur.fetchall():
-            Latitude,Longitude = float(record[0]), float(record[1])
-            if abs(Latitude) > 0.00001 and abs(Longitude) > 0.00001:    
-                logging.debug ("Latitude: %s Longitude: %s  -- %s",Latitude,Longitude,record[2])
-                dPhi=math.radians(Latitude-self.latitude)
-                dLambda=math.radians(Longitude-self.longitude)
-                radius=6371000 # meters
-                a =math.sin(dPhi/2) * math.sin(dPhi/2) + \
-                   math.cos(math.radians(Latitude)) * math.cos(math.radians(self.latitude)) * \
-	           math.sin(dLambda/2)*math.sin(dLambda/2)
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-                d = radius * c
-                logging.debug("   --> distance=%f km"%(d/1000))
-                theList.append((d/1000,record[2]))
-        theList.sort()
-        for i in theList:
-            #print ("%s:%s"%(i[1],i[0]))
-            print ("%s"%(i[1]))
+        cur.execute("select name from sqlite_master where name='locations'")
+        spatial = bool(cur.fetchall())
+        for theBox in theBoxes:
+
+            # The spatial index is slower than reading metadata when every location
+            # is wanted
+
+            if spatial and theBox != (-90.0, 90.0, -180.0, 180.0):
+                query = ("select metadata.latitude, metadata.longitude, dirs.path || '/' || files.name "
+                         "from locations join metadata on metadata.id = locations.id "
+                         "join files on files.hash = metadata.hash join dirs on dirs.id = files.dir "
+                         "where locations.maxLat >= ? and locations.minLat <= ? "
+                         "and locations.maxLong >= ? and locations.minLong <= ?")
+            else:
+                query = ("select latitude, longitude, dirs.path || '/' || files.name from metadata "
+                         "join files on files.hash = metadata.hash join dirs on dirs.id = files.dir "
+                         "where latitude between ? and ? and longitude between ? and ? "
+                         "and abs(latitude) > 0.00001 and abs(longitude) > 0.00001")
+            cur.execute(query, theBox)
+            for record in cur:
+                yield record
 
-            
     def map(self,filename):
         """ Build an HTML page that uses the Google Maps API to show the geolocation
             of all hashes that have lattitude  and longitude information.  Clicking
@@ -417,28 +1559,22 @@ class Database:
             filename : The name of the output html file.
 
             returns: None
-        """
-        
-        map = Map()
-        cur = self.con.cursor()
-        cur.execute("select latitude, longitude, path from metadata, files "
-                    "where files.hash = metadata.hash "
-                    "and latitude not null "
-                    "and longitude not null "
-                    )
-        for record in cur.fetchall():
-            Latitude,Longitude = float(record[0]), float(record[1])
-            if abs(Latitude) > 0.00001 and abs(Longitude) > 0.00001:    
-                logging.info ("Latitude: %s Longitude: %s  -- %s",Latitude,Longitude,record[2])
-                map.add_point((Latitude, Longitude, record[2]))
 
+            The files are read from the spatial index in one pass, and written to the
+            page as they are read, so the page can be as large as the database.  Nearby
+            files are grouped into clusters for each zoom level as they go, so the page
+            only draws one marker for each cluster in view.
+        """
         with open(filename, "w") as out:
-            print(map, file=out)
+            theMap = Map(out)
+            for (Latitude, Longitude, thePath) in self.locatedFiles([(-90.0, 90.0, -180.0, 180.0)]):
+                theMap.add_point((Latitude, Longitude, thePath))
+            theMap.close()
+        logging.info("Wrote %d files to map %s", theMap.count, filename)
 
-        
     def close(self):
         """ Commit changes and close the database """
-        if self.latitude and not self.longitude:
+        if self.latitude is not None and self.longitude is None:
             logging.warning("Geolocation requires both latitude and longitude.  Missing longitude")
 
         if self.con:
@@ -447,79 +1583,610 @@ class Database:
             self.con.close()
 
 class Map(object):
-    def __init__(self):
-        self._points = []
+    """ Write an HTML page that uses the Google Maps API to show a set of points.
+
+        Points are written to the page, as a JSON array, as they are added.  Points
+        are also grouped into clusters on a grid for each zoom level up to
+        MAP_MAX_ZOOM, with cells MAP_CELL pixels across, and the clusters are written
+        when the map is closed.  The page draws the clusters in view at the current
+        zoom level, or the points in view when there are not many fewer clusters
+        than points, or when zoomed in further.
+    """
+
+    header = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>html, body, #map-canvas { height: 100%; width: 100%; margin: 0 }</style>
+<script src="https://maps.googleapis.com/maps/api/js?v=3.exp&sensor=false"></script>
+</head>
+<body>
+<div id="map-canvas"></div>
+<script type="text/javascript">
+var points = ["""
+
+    footer = """;
+var map, markers = [];
+function show_markers() {
+    var bounds = map.getBounds(), zoom = map.getZoom();
+    markers.forEach(function(marker) { marker.setMap(null); });
+    markers = [];
+    if (!bounds) return;
+    var clustered = zoom <= maxZoom && clusters[zoom];
+    (clustered ? clusters[zoom] : points).forEach(function(x) {
+        var position = new google.maps.LatLng(x[0], x[1]), marker;
+        if (!bounds.contains(position)) return;
+        if (clustered && x[2] > 1) {
+            marker = new google.maps.Marker({position: position, map: map,
+                                             label: String(x[2]), title: x[2] + " files"});
+            marker.addListener('click', function() {
+                map.setCenter(position);
+                map.setZoom(zoom + 2);
+            });
+        } else {
+            var file = clustered ? points[x[3]][2] : x[2];
+            marker = new google.maps.Marker({position: position, map: map, title: file});
+            marker.addListener('click', function() {
+                window.open(file, '_blank');
+            });
+        }
+        markers.push(marker);
+    });
+}
+function show_map() {
+    map = new google.maps.Map(document.getElementById("map-canvas"), {
+        zoom: 3,
+        center: new google.maps.LatLng(0,0)
+    });
+    map.addListener('idle', show_markers);
+}
+google.maps.event.addDomListener(window, 'load', show_map);
+</script>
+</body>
+</html>
+"""
+
+    def __init__(self, theFile):
+        """ Constructor
+
+            theFile: A file, open for writing, to write the page to
+        """
+        self.out = theFile
+        self.count = 0
+        self.cells = {}
+        self.out.write(self.header)
+
     def add_point(self, coordinates):
-        self._points.append(coordinates)
-    def __str__(self):
-        centerLat = sum(( x[0] for x in self._points )) / len(self._points)
-        centerLon = sum(( x[1] for x in self._points )) / len(self._points)
-        markersCode = "\n".join(
-            [ """var marker = new google.maps.Marker({{
-                position: new google.maps.LatLng({lat}, {lon}),
-                map: map,
-                title: '{file}'
-                }});
-                marker.addListener('click', function() {{
-                window.open('{file}', '_blank');
-                }});
-            """.format(lat=x[0], lon=x[1], file=x[2]) for x in self._points
-            ])
-        return """
-            <script src="https://maps.googleapis.com/maps/api/js?v=3.exp&sensor=false"></script>
-            <div id="map-canvas" style="height: 100%; width: 100%"></div>
-            <script type="text/javascript">
-                var map;
-                function show_map() {{
-                    map = new google.maps.Map(document.getElementById("map-canvas"), {{
-                        zoom: 3,
-                        center: new google.maps.LatLng(0,0)
-                    }});
-                    {markersCode}
-                }}
-                google.maps.event.addDomListener(window, 'load', show_map);
-            </script>
-        """.format(markersCode=markersCode)
-
-
-def sameDir(thePath, theFile):
-    """ Check two paths, one of which is a full path name for a file,
-        and the other may be a path to a directory or to a file.
-        Determine if they represent a file in the given directory,  whether they
-        represent full pahs to two different files in the same directory,
-        or whether they represent two different files in the same directory
-
-        theFile: A string representing the full path name of a file
-        thePath: A string representing the full path to a directory or a file
-
-        returns:  True  -- if thePath is a directory and theFile is a
-                           file in thePath.
-
-                           if thePath is a file and that file is in the
-                           same directory that theFile is in.
-        returns:  False -- Otherwise. (If theFile is not in the directory thePath
-                           or if theFile is in a differnet directory than a file
-                           represented by thePath)
-    """
-    theFile = theFile.split("/")
-    thePath = thePath.split("/")
-
-    # if the base paths are different lengths, they are not in the same directory.
-    # if both are files and the files are both in the same directory, the lengths are the same
-    # if one is a directory, and the other a file in that directory, the file path will be one
-    # longer.
-    if len(theFile) - len(thePath) > 1: return False
-
-    # See if the base paths are the same.  If the file path is longer,
-    # don't worry about the last element -- it is the file name
-    for z in range(len(theFile)-1):
-        logging.debug("     %s   --   %s", thePath[z], theFile[z])
-        if thePath[z] != theFile[z]: return False
-    logging.debug("[sameDir]   %s", theFile)
-    logging.debug("[sameDir]     is in the")
-    logging.debug("[sameDir]        %s directory", thePath)
-    return True
+        """ Add a point to the map
+
+            coordinates: A (latitude, longitude, path) tuple
+            returns:     None
+        """
+        (Latitude, Longitude, thePath) = coordinates
+        self.out.write("%s\n[%.6f,%.6f,%s]" % ("," if self.count else "", Latitude, Longitude,
+                                              json.dumps(thePath).replace("</", "<\\/")))
+
+        # Only the cell of the point on the finest grid, in Web Mercator coordinates,
+        # is found here.  The clusters of the coarser grids are found from those
+
+        cells = (1 << MAP_MAX_ZOOM) * 256 // MAP_CELL
+        phi = math.radians(max(-85.05112878, min(85.05112878, Latitude)))
+        x = min(int((Longitude + 180) / 360 * cells), cells - 1)
+        y = min(int((1 - math.log(math.tan(phi) + 1 / math.cos(phi)) / math.pi) / 2 * cells), cells - 1)
+        cluster = self.cells.get((x, y))
+        if cluster:
+            cluster[0] += Latitude
+            cluster[1] += Longitude
+            cluster[2] += 1
+        else:
+            self.cells[(x, y)] = [Latitude, Longitude, 1, self.count]
+        self.count += 1
+
+    def close(self):
+        """ Write the clusters and the rest of the page.  The file is not closed
+
+            returns: None
+
+            The clusters of each zoom level are made by merging the clusters of the
+            next finer level, four cells to one.  A level where most clusters hold
+            a single point is written as null, and the page shows the points instead.
+        """
+        (levels, cells) = ([], self.cells)
+        for z in range(MAP_MAX_ZOOM, -1, -1):
+            levels.append(cells if len(cells) * 2 <= self.count else None)
+            (coarser, cells) = (cells, {})
+            for ((x, y), theCluster) in coarser.items():
+                cluster = cells.get((x >> 1, y >> 1))
+                if cluster:
+                    cluster[0] += theCluster[0]
+                    cluster[1] += theCluster[1]
+                    cluster[2] += theCluster[2]
+                    cluster[3] = min(cluster[3], theCluster[3])
+                else:
+                    cells[(x >> 1, y >> 1)] = list(theCluster)
+        self.out.write("];\nvar maxZoom = %d;\nvar clusters = [" % MAP_MAX_ZOOM)
+        for (z, clusters) in enumerate(reversed(levels)):
+            self.out.write("," if z else "")
+            if clusters is None:
+                self.out.write("\nnull")
+                continue
+            self.out.write("\n[%s]" % ",".join("[%.6f,%.6f,%d,%d]" % (x[0] / x[2], x[1] / x[2], x[2], x[3])
+                                                 for x in clusters.values()))
+        self.out.write("]")
+        self.out.write(self.footer)
+
+
+class Stats(object):
+    """ Counters and timers for a run, for the --stats option.  Nothing is counted
+        unless enabled is set, so the calls to count and addTime can stay in the
+        hashing and database code.  Counters may be updated from any thread.
+
+        Each dispatched action is a phase.  The counters and the wall clock time of
+        each phase are recorded, and a progress line, with an estimate of the time
+        remaining when the number of files to process is known, is written to stderr
+        at most once every PROGRESS_INTERVAL seconds.
+    """
+
+    # The counters and timers, in the order they are reported.  Times are summed
+    # over all threads, so with JOBS > 1 they can be longer than the wall clock time
+    counterNames = ("files_walked", "files_hashed", "bytes_hashed", "files_partially_hashed",
+                    "bytes_partially_hashed", "rows_written", "files_checked", "bytes_compared")
+    timerNames = ("hash", "database", "compare")
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.counterNames, 0)
+        self.timers = dict.fromkeys(self.timerNames, 0.0)
+        self.phases = []
+        self.phase = None
+        self.started = time.monotonic()
+        self.lastProgress = self.started
+        self.progressShown = False
+
+    def count(self, theCounter, theAmount=1):
+        """ Add to a counter, and show the progress line if it is due
+
+            theCounter: One of counterNames
+            theAmount:  The amount to add.  Default 1
+            returns:    None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[theCounter] += theAmount
+            if time.monotonic() - self.lastProgress >= PROGRESS_INTERVAL:
+                self.progress()
+
+    def addTime(self, theTimer, theSeconds):
+        """ Add to a timer
 
+            theTimer:   One of timerNames
+            theSeconds: The number of seconds to add
+            returns:    None
+        """
+        if self.enabled:
+            with self.lock:
+                self.timers[theTimer] += theSeconds
+
+    def startPhase(self, theName):
+        """ Start timing a dispatched action.  The counters reported for the phase
+            are the changes from their values now
+
+            theName: The name of the action, such as "path" or "check"
+            returns: None
+        """
+        self.phase = {"name": theName, "started": time.monotonic(), "expected": None,
+                      "counter": None, "counters": dict(self.counters), "timers": dict(self.timers)}
+
+    def expect(self, theTotal, theCounter):
+        """ Record how much work the current phase has to do, so that the progress line
+            can estimate the time remaining
+
+            theTotal:   The number of things the phase will count
+            theCounter: The counter that counts them, one of counterNames
+            returns:    None
+        """
+        if self.phase:
+            (self.phase["expected"], self.phase["counter"]) = (theTotal, theCounter)
+            self.phase["base"] = self.counters[theCounter]
+
+    def endPhase(self):
+        """ Finish timing the current phase
+
+            returns: None
+        """
+        if not self.phase:
+            return
+        with self.lock:
+            self.clearProgress()
+            phase = self.phase
+            self.phases.append({"name": phase["name"],
+                                "seconds": time.monotonic() - phase["started"],
+                                "counters": dict((x, self.counters[x] - phase["counters"][x])
+                                                 for x in self.counterNames),
+                                "timers": dict((x, self.timers[x] - phase["timers"][x])
+                                               for x in self.timerNames)})
+            self.phase = None
+
+    def progress(self):
+        """ Write the progress line to stderr.  On a terminal the line is rewritten in
+            place.  Otherwise a new line is written each time.  Called with lock held
+
+            returns: None
+        """
+        now = time.monotonic()
+        self.lastProgress = now
+        phase = self.phase or {"name": "", "started": self.started, "expected": None}
+        elapsed = now - phase["started"]
+        line = "%s: %d files walked, %d hashed, %.1f MB at %.1f MB/s, %d rows written" % (
+            phase["name"], self.counters["files_walked"], self.counters["files_hashed"],
+            self.counters["bytes_hashed"] / 1048576.0,
+            self.counters["bytes_hashed"] / 1048576.0 / max(now - self.started, 1e-9),
+            self.counters["rows_written"])
+        if self.counters["files_checked"]:
+            line += ", %d checked" % self.counters["files_checked"]
+        if phase["expected"]:
+            done = self.counters[phase["counter"]] - phase["base"]
+            if done:
+                remaining = max(0, phase["expected"] - done) * elapsed / done
+                line += ", %d%%, ETA %s" % (min(100, 100 * done // phase["expected"]),
+                                           time.strftime("%H:%M:%S", time.gmtime(remaining)))
+        if sys.stderr.isatty():
+            sys.stderr.write("\r\033[K" + line)
+            self.progressShown = True
+        else:
+            sys.stderr.write(line + "\n")
+        sys.stderr.flush()
+
+    def clearProgress(self):
+        """ End the progress line, so that what follows starts on a new line
+
+            returns: None
+        """
+        if self.progressShown:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            self.progressShown = False
+
+    def summary(self):
+        """ Return the statistics for the run
+
+            returns: A dictionary of the totals, the throughput, and the phases
+        """
+        seconds = time.monotonic() - self.started
+        return {"seconds": seconds,
+                "counters": dict(self.counters),
+                "timers": dict(self.timers),
+                "throughput": {
+                    "files_per_second": ((self.counters["files_walked"] + self.counters["files_checked"]) / seconds
+                                         if seconds else None),
+                    "MBps": self.counters["bytes_hashed"] / 1048576.0 / seconds if seconds else None,
+                    "hash_MBps": (self.counters["bytes_hashed"] / 1048576.0 / self.timers["hash"]
+                                  if self.timers["hash"] else None),
+                    "rows_per_second": (self.counters["rows_written"] / self.timers["database"]
+                                        if self.timers["database"] else None)},
+                "phases": self.phases}
+
+    def report(self, theFileName=None):
+        """ Write the statistics for the run
+
+            theFileName: If given, write the statistics to this file as JSON.  Otherwise
+                         write a summary to stderr
+            returns:     None
+        """
+        self.clearProgress()
+        summary = self.summary()
+        if theFileName:
+            with open(theFileName, "w") as afile:
+                json.dump(summary, afile, indent=2)
+                afile.write("\n")
+            return
+        lines = ["Statistics (%.1f seconds):" % summary["seconds"]]
+        for phase in summary["phases"]:
+            lines.append("  %-10s %10.3f s" % (phase["name"], phase["seconds"]))
+        for x in self.counterNames:
+            if x.startswith("bytes"):
+                lines.append("  %-24s %.1f MB" % (x, self.counters[x] / 1048576.0))
+            else:
+                lines.append("  %-24s %d" % (x, self.counters[x]))
+        for x in self.timerNames:
+            lines.append("  %-24s %.3f s" % (x + " time", self.timers[x]))
+        for x, value in summary["throughput"].items():
+            if value is not None:
+                lines.append("  %-24s %.1f" % (x, value))
+        sys.stderr.write("\n".join(lines) + "\n")
+
+STATS = Stats()
+
+
+class ScanSession(object):
+    """ Record the progress of a scan in the database, so that a scan that is
+        interrupted can be continued with RESUME.
+
+        A directory is complete once the walk has listed it and every file in it that
+        needed to be written has been committed.  Complete directories are recorded
+        in the scanned table in the same transaction as their last files, so a
+        resumed scan does not look at the files in them again, although it still
+        walks the directories below them.  The files in directories that are not
+        complete are checked as usual, so only those that were not committed are
+        hashed again.  A staged scan writes all of its files at the end, so it only
+        completes directories then.
+
+        The walk calls started and walked, and the writer calls written, possibly
+        from another thread.
+    """
+
+    def __init__(self, theDatabase, thePath):
+        """ Constructor
+              Start a scan of a tree, or resume the interrupted scan of it if RESUME
+              is set.  Any other interrupted scan of the tree is discarded
+
+              theDatabase: The Database to record the scan in
+              thePath:     The top of the tree
+              returns: None
+        """
+        self.lock = threading.Lock()
+        (self.pending, self.listed, self.completed) = ({}, set(), [])
+        self.root = os.path.abspath(thePath)
+        self.con = theDatabase.con
+        records = self.con.execute("select id, started from scans where root=?", (self.root, )).fetchall()
+        if records and RESUME:
+            (self.id, started) = records[0]
+            logging.warning("Resuming scan of %s started at %s", self.root, started)
+            return
+        if RESUME:
+            logging.warning("No interrupted scan of %s to resume", self.root)
+        with self.con:
+            self.con.execute("delete from scanned where scan in (select id from scans where root=?)",
+                             (self.root, ))
+            self.con.execute("delete from scans where root=?", (self.root, ))
+            self.id = self.con.execute("insert into scans (root, started) values (?, ?)",
+                                       (self.root, datetime.datetime.now().isoformat(" ", "seconds"))).lastrowid
+
+    def isComplete(self, theDirectory):
+        """ Check whether an earlier run of the scan completed a directory
+
+            theDirectory: The full path to the directory
+            returns:      True if the directory is complete.  False otherwise
+        """
+        return bool(self.con.execute("select 1 from scanned where scan=? and path=?",
+                                     (self.id, theDirectory)).fetchall())
+
+    def started(self, thePath):
+        """ Record that a file will be written to the database
+
+            thePath: The full path to the file
+            returns: None
+        """
+        directory = os.path.dirname(thePath)
+        with self.lock:
+            self.pending[directory] = self.pending.get(directory, 0) + 1
+
+    def walked(self, theDirectory):
+        """ Record that the walk has found all of the files in a directory
+
+            theDirectory: The full path to the directory
+            returns:      None
+        """
+        with self.lock:
+            if self.pending.get(theDirectory):
+                self.listed.add(theDirectory)
+            else:
+                self.completed.append((self.id, theDirectory))
+
+    def written(self, theCon, thePaths):
+        """ Record that files have been written, and record the directories that are
+            now complete.  Call this within the transaction that writes the files
+
+            theCon:   The connection that is writing the files
+            thePaths: A list of the full paths to the files
+            returns:  None
+        """
+        with self.lock:
+            for thePath in thePaths:
+                directory = os.path.dirname(thePath)
+                if directory not in self.pending:
+                    continue
+                self.pending[directory] -= 1
+                if not self.pending[directory]:
+                    del self.pending[directory]
+                    if directory in self.listed:
+                        self.listed.remove(directory)
+                        self.completed.append((self.id, directory))
+            (completed, self.completed) = (self.completed, [])
+        theCon.executemany("insert or ignore into scanned values (?, ?)", completed)
+
+    def finish(self):
+        """ Discard the record of a scan that has finished
+
+            returns: None
+        """
+        with self.con:
+            self.con.execute("delete from scanned where scan=?", (self.id, ))
+            self.con.execute("delete from scans where id=?", (self.id, ))
+
+# The scan in progress, if any
+SESSION = None
+
+
+def distance(theLatitude, theLongitude, theOtherLatitude, theOtherLongitude):
+    """ Return the great circle distance between two locations, using the
+        haversine formula
+
+        Locations are given as latitude and longitude in degrees
+        returns: The distance in km
+    """
+    dPhi = math.radians(theOtherLatitude - theLatitude)
+    dLambda = math.radians(theOtherLongitude - theLongitude)
+    a = math.sin(dPhi / 2) ** 2 + \
+        math.cos(math.radians(theLatitude)) * math.cos(math.radians(theOtherLatitude)) * \
+        math.sin(dLambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+def normalDateTime(theValue):
+    """ Convert a date and time, as read from exif data, to the form stored in the
+        database, "YYYY-MM-DD HH:MM:SS"
+
+        theValue: A datetime, or a string such as "YYYY:MM:DD HH:MM:SS"
+        returns:  A string, or None if theValue is not a valid date
+    """
+    if theValue is None:
+        return None
+    if not isinstance(theValue, datetime.datetime):
+        match = dateTimePattern.match(str(theValue).strip())
+        if not match:
+            return None
+        try:
+            theValue = datetime.datetime(*[int(x or 0) for x in match.groups()])
+        except ValueError:
+            return None
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (theValue.year, theValue.month, theValue.day,
+                                              theValue.hour, theValue.minute, theValue.second)
+
+def dateBound(theValue):
+    """ Check a date given on the command line, and convert it to the form stored in
+        the database.  The date may be shortened, to "YYYY-MM" for example, and may use
+        the exif form, "YYYY:MM:DD HH:MM:SS"
+
+        theValue: A string
+        returns:  A string that is the start of a date and time in the database form
+        raises:   ValueError if theValue is not a date
+    """
+    match = dateBoundPattern.match(theValue.strip())
+    if not match:
+        raise ValueError(theValue)
+    parts = [x for x in match.groups() if x is not None]
+    datetime.datetime(*([int(x) for x in parts] + [1, 1])[:max(3, len(parts))])
+    return "".join(y + x for (x, y) in zip(parts, ("", "-", "-", " ", ":", ":")))
+
+def boundingBoxes(theLatitude, theLongitude, theRadius):
+    """ Return the boxes of latitude and longitude that hold every location within a
+        distance of a location.  A circle that crosses the antimeridian needs two
+        boxes, and one that reaches a pole covers every longitude
+
+        theLatitude:  The latitude of the centre, in degrees
+        theLongitude: The longitude of the centre, in degrees
+        theRadius:    The distance, in km
+        returns:      A list of (minimum latitude, maximum latitude, minimum longitude,
+                      maximum longitude) tuples
+    """
+    angle = theRadius / EARTH_RADIUS
+    dLat = math.degrees(angle)
+    (minLat, maxLat) = (theLatitude - dLat, theLatitude + dLat)
+    if minLat <= -90 or maxLat >= 90:
+        return [(max(minLat, -90.0), min(maxLat, 90.0), -180.0, 180.0)]
+    dLong = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(theLatitude))))
+    (minLong, maxLong) = (theLongitude - dLong, theLongitude + dLong)
+    if minLong < -180:
+        return [(minLat, maxLat, minLong + 360, 180.0), (minLat, maxLat, -180.0, maxLong)]
+    if maxLong > 180:
+        return [(minLat, maxLat, minLong, 180.0), (minLat, maxLat, -180.0, maxLong - 360)]
+    return [(minLat, maxLat, minLong, maxLong)]
+
+def printGroups(theRecords, theUnit="files"):
+    """ Print groups of duplicate files
+
+        theRecords: An iterable of (hash, path, size, algorithm, device, inode)
+                    tuples, ordered by hash
+        theUnit:    What the paths are, for the text output
+        returns:    None
+
+        The output format is set by OUTPUT_FORMAT:
+
+          text: The hash and counts, followed by one indented line per path
+          json: A JSON array with one object per hash
+          csv:  One row per path, with the algorithm, hash, count, size and
+                reclaimable bytes
+    """
+    if OUTPUT_FORMAT == "csv":
+        out = csv.writer(sys.stdout)
+        out.writerow(("algorithm", "hash", "count", "size", "reclaimable", "path"))
+    elif OUTPUT_FORMAT == "json":
+        separator = "[\n"
+    for theHash, group in itertools.groupby(theRecords, key=lambda x: x[0]):
+        group = list(group)
+        (count, sizes) = (len(group), set(x[2] for x in group))
+        size = sizes.pop() if len(sizes) == 1 else None
+
+        # Hard links to the same file share its data, so purging them reclaims nothing
+
+        inodes = len(set(x[4:] if None not in x[4:] else x[1] for x in group))
+        reclaimable = size * (inodes - 1) if size is not None else None
+        if OUTPUT_FORMAT == "csv":
+            for x in group:
+                out.writerow((group[0][3], theHash, count, size, reclaimable, x[1]))
+        elif OUTPUT_FORMAT == "json":
+            print(separator + json.dumps({"algorithm": group[0][3], "hash": theHash,
+                                          "count": count, "size": size,
+                                          "reclaimable": reclaimable,
+                                          "paths": [x[1] for x in group]}), end="")
+            separator = ",\n"
+        else:
+            print("Hash %s (%d %s, %s bytes reclaimable)" %
+                  (theHash, count, theUnit, reclaimable if reclaimable is not None else "unknown"))
+            for x in group:
+                print("  %s" % x[1])
+    if OUTPUT_FORMAT == "json":
+        print("[]" if separator == "[\n" else "\n]")
+
+
+def splitPath(thePath):
+    """ Split the full path to a file into the path of its directory, as it is recorded
+        in the dirs table, and its name.  The root directory is recorded as "", so
+        that the path of a file is always the path of its directory, "/" and its name
+
+        thePath: The full path to a file
+        returns: A (directory, name) tuple
+    """
+    (directory, separator, name) = thePath.rpartition("/")
+    return (directory, name)
+
+def hashToBlob(theHash):
+    """ Return a hash in the binary form in which it is stored in the database
+
+        theHash: A hash in hex, as returned by HashFile, or None
+        returns: The hash as bytes, or None
+    """
+    return bytes.fromhex(theHash) if theHash else None
+
+def blobToHash(theBlob):
+    """ Return a hash that was stored in the database in hex, as returned by HashFile
+
+        theBlob: A hash as bytes, or None
+        returns: The hash in hex, or None
+    """
+    return theBlob.hex() if theBlob is not None else None
+
+def dirRange(thePath):
+    """ Return a condition that selects a directory and all of the directories below
+        it from the dirs table.  The condition compares the path with a range, so it
+        can use the index on path, and no character in thePath is special, as _ and %
+        are in LIKE.  A directory only contains the directories below it, so /a/b does
+        not select /a/bc
+
+        thePath: The full path to the directory
+        returns: A (condition, parameters) tuple, for a WHERE clause on the dirs table
+    """
+
+    # "0" is the character after "/", so every path that starts with base + "/" is
+    # in the range
+
+    base = thePath.rstrip("/")
+    return ("(path = ? or (path >= ? and path < ?))", (base, base + "/", base + "0"))
+
+def pathRange(thePath):
+    """ Return a condition that selects a file, or a directory and all of the files in
+        it, by path.  The directories are selected by dirRange, so the condition uses
+        the indexes on the paths of directories and on the keys of files
+
+        thePath: The full path to the file or directory
+        returns: A (condition, parameters) tuple, for a WHERE clause on the files table
+    """
+    (condition, parameters) = dirRange(thePath)
+    return ("(files.dir in (select id from dirs where %s) or "
+            "(files.dir = (select id from dirs where path = ?) and files.name = ?))" % condition,
+            parameters + splitPath(thePath))
 
 def initDB(theFileName):
     """Helper function to open instanciate the database and initialize it.
@@ -532,50 +2199,1010 @@ def initDB(theFileName):
     theDatabase = Database(theFileName)
 
 
-def HashFile(theFile):
-    """Return the SHA2-256 hash of a file
-       theFile:  A string representing the full path name of the file
-                 to be hashed
-       returns:  A string representing the hex values of the sha2-256
-                 hash of the file
+def readBuffer():
+    """ Return the buffer that HashFile reads into on this thread.  It is only
+        allocated again if BLOCKSIZE has changed
+
+        returns: A bytearray of BLOCKSIZE bytes
     """
-    hasher = hashlib.sha256()
+    buf = getattr(readBuffers, "buf", None)
+    if buf is None or len(buf) != BLOCKSIZE:
+        buf = readBuffers.buf = bytearray(BLOCKSIZE)
+    return buf
+
+def HashFile(theFile, theAlgorithm=None):
+    """Return the hash of a file
+       theFile:      A string representing the full path name of the file
+                     to be hashed
+       theAlgorithm: The name of the hash algorithm to use, one of the keys of
+                     hashAlgorithms.  Default ALGORITHM
+       returns:      A string representing the hex values of the hash of the file
+
+       The file is read BLOCKSIZE bytes at a time into a buffer that each thread
+       keeps, and reuses for every block of every file it hashes.
+    """
+    hasher = hashAlgorithms[theAlgorithm or ALGORITHM]()
     afile = None
 
     logging.info("Hashing file %s", theFile)
-    if not os.path.exists(theFile):
+    try:
+        (start, total) = (time.perf_counter(), 0)
+        with open(theFile, 'rb', buffering=0) as afile:
+            buf = readBuffer()
+            view = memoryview(buf)
+            length = afile.readinto(buf)
+            while length:
+                hasher.update(view[:length])
+                total += length
+                length = afile.readinto(buf)
+            afile.close()
+            digest = hasher.hexdigest()
+            logging.debug("%s : %s", digest, theFile)
+            STATS.addTime("hash", time.perf_counter() - start)
+            STATS.count("bytes_hashed", total)
+            STATS.count("files_hashed")
+            return digest
+    except FileNotFoundError:
         logging.warning("File %s no longer exists", theFile)
         return None
+    except PermissionError:
+        logging.warning("Unable to read %s", theFile)
+        if afile != None:
+            afile.close()
+        return None
+
+def PartialHashFile(theFile, theSize, theAlgorithm=None):
+    """Return the hash of the first and last blocks of a file.
+       Files no larger than two blocks are read completely, so for those
+       files this is the same as the value returned by HashFile
+
+       theFile:      A string representing the full path name of the file
+                     to be hashed
+       theSize:      The size of the file in bytes
+       theAlgorithm: The name of the hash algorithm to use.  Default ALGORITHM
+       returns:      A string representing the hex values of the hash, or None
+                     if the file could not be read
+    """
+    hasher = hashAlgorithms[theAlgorithm or ALGORITHM]()
+
+    logging.info("Partially hashing file %s", theFile)
     try:
+        start = time.perf_counter()
         with open(theFile, 'rb') as afile:
-            buf = afile.read(BLOCKSIZE)
+            buf = afile.read(PARTIAL_BLOCKSIZE)
+            total = len(buf)
+            hasher.update(buf)
+            if theSize > 2 * PARTIAL_BLOCKSIZE:
+                afile.seek(-PARTIAL_BLOCKSIZE, os.SEEK_END)
+            buf = afile.read(PARTIAL_BLOCKSIZE)
             while len(buf) > 0:
                 hasher.update(buf)
-                buf = afile.read(BLOCKSIZE)
-            afile.close()
-            logging.debug("%s : %s", hasher.hexdigest(), theFile)
-            return hasher.hexdigest()
-    except PermissionError:
+                total += len(buf)
+                buf = afile.read(PARTIAL_BLOCKSIZE)
+    except OSError:
         logging.warning("Unable to read %s", theFile)
-        if afile != None:
-            afile.close()
         return None
+    STATS.addTime("hash", time.perf_counter() - start)
+    STATS.count("bytes_partially_hashed", total)
+    STATS.count("files_partially_hashed")
+    return hasher.hexdigest()
+
+def fileStat(theStat):
+    """ Convert the result of os.stat to the FileStat recorded in the database
+
+        theStat: An os.stat_result
+        returns: A FileStat
+    """
+    return FileStat(theStat.st_size, theStat.st_mtime_ns, theStat.st_ino, theStat.st_dev)
+
+def isExcluded(thePath):
+    """ Check whether a file or directory is excluded from scans
+
+        thePath: The full path of the file or directory
+        returns: True if its name or its path matches EXCLUDE
+    """
+    return bool(EXCLUDE and (EXCLUDE.match(os.path.basename(thePath)) or EXCLUDE.match(thePath)))
+
+def isSelectedSize(theSize):
+    """ Check whether a file is within the sizes to be scanned
+
+        theSize: The size of the file in bytes
+        returns: False if the file is smaller than MIN_SIZE or larger than MAX_SIZE
+    """
+    return not ((MIN_SIZE and theSize < MIN_SIZE) or (MAX_SIZE is not None and theSize > MAX_SIZE))
+
+def isUnchanged(thePath, theSize, theMtime):
+    """ Check whether a file recorded in the database is still as it was recorded
+
+        thePath:  The full path to the file
+        theSize:  The recorded size of the file
+        theMtime: The recorded modification time of the file, in ns, or None if it
+                  was not recorded
+        returns:  True if the file exists and its size and modification time match
+    """
+    try:
+        theStat = os.stat(thePath)
+    except OSError:
+        return False
+    return theStat.st_size == theSize and theMtime in (None, theStat.st_mtime_ns)
+
+def WalkDir(thePath):
+    """ Walk a directory tree
+
+        thePath: A string that specifies the top directory tree
+
+        returns: A generator of (path, FileStat, links) tuples, one for each file in
+                 the tree.  links is the number of hard links to the file
+
+        Only regular files are returned, so FIFOs, sockets and devices, which could
+        block HashFile, are skipped.  The type of each entry comes from the directory
+        listing, and each file is stat'ed once.  Files and directories that match
+        EXCLUDE, and files smaller than MIN_SIZE or larger than MAX_SIZE, are
+        skipped.  With ONE_FILE_SYSTEM, directories on other file systems are skipped.
+        SYMLINKS is "skip" to skip symbolic links, "files" to follow links to files,
+        or "follow" to follow links to files and directories.  During a scan, the
+        files in directories that SESSION has completed are skipped, and the
+        directories that have been listed are reported to it.
+    """
+    root = os.path.abspath(thePath)
+    try:
+        rootStat = os.stat(root)
+    except OSError as e:
+        logging.warning("Unable to read directory %s: %s", root, e)
+        return
+    visited = {(rootStat.st_dev, rootStat.st_ino)}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        complete = SESSION is not None and SESSION.isComplete(directory)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.warning("Unable to read directory %s: %s", directory, e)
+            continue
+        for entry in entries:
+            if isExcluded(entry.path):
+                logging.debug("Excluding %s", entry.path)
+                continue
+            try:
+                isLink = entry.is_symlink()
+                if isLink and SYMLINKS == "skip":
+                    continue
+                if entry.is_dir(follow_symlinks=False) or (isLink and SYMLINKS == "follow" and entry.is_dir()):
+                    theStat = entry.stat(follow_symlinks=isLink)
+                    if ONE_FILE_SYSTEM and theStat.st_dev != rootStat.st_dev:
+                        logging.info("Skipping %s on another file system", entry.path)
+                        continue
+
+                    # When links are followed, a directory may be reached more than once
+
+                    if (theStat.st_dev, theStat.st_ino) in visited:
+                        continue
+                    visited.add((theStat.st_dev, theStat.st_ino))
+                    stack.append(entry.path)
+                    continue
+                if complete:
+                    continue
+                if not (entry.is_file(follow_symlinks=False) or (isLink and entry.is_file())):
+                    logging.debug("Skipping %s, which is not a regular file", entry.path)
+                    continue
+                theStat = entry.stat(follow_symlinks=isLink)
+            except OSError:
+                logging.warning("File %s no longer exists", entry.path)
+                continue
+            if not isSelectedSize(theStat.st_size):
+                continue
+            STATS.count("files_walked")
+            yield (entry.path, fileStat(theStat), theStat.st_nlink)
+        if SESSION is not None and not complete:
+            SESSION.walked(directory)
+
+def ChangedFiles(thePath, needHash=True):
+    """ Walk a directory tree and find the files that are not current in the database.
+        Unless a rehash was requested, files that have the same size, modification time,
+        inode and device as when they were last recorded are skipped without being read
+
+        thePath:  A string that specifies the top directory tree
+        needHash: If True, files recorded without a hash are not considered current
+
+        returns: A generator of (path, FileStat, links) tuples
+    """
+    for theFilePath, theStat, theLinks in WalkDir(thePath):
+        if not REHASH and theDatabase.isCurrent(theFilePath, theStat, needHash):
+            logging.debug("Skipping unchanged file %s", theFilePath)
+            continue
+        if SESSION:
+            SESSION.started(theFilePath)
+        yield (theFilePath, theStat, theLinks)
+
+def HashFiles(theEntries):
+    """ Hash a sequence of files.  A file with more than one hard link is only read
+        the first time it is seen, or not at all if another link to it is already
+        in the database
+
+        theEntries: An iterable of (path, FileStat, links) tuples
+        returns:    A generator of (hash, path, FileStat, partial) tuples for
+                    Database.writeMany
+    """
+    seen = {}
+    for theFilePath, theStat, theLinks in theEntries:
+        theHash = None
+        if theLinks > 1:
+            inode = (theStat.device, theStat.inode)
+            if inode not in seen:
+                seen[inode] = theDatabase.linkedHash(theStat)
+            theHash = seen[inode]
+            if theHash:
+                logging.debug("%s is a link to a file that has been hashed", theFilePath)
+        if not theHash:
+            theHash = HashFile(theFilePath)
+            if theLinks > 1:
+                seen[inode] = theHash
+        yield (theHash, theFilePath, theStat, None)
+
+def mapFiles(theFunction, *theArgs):
+    """ Apply a function to each of a list of files, using the hashing thread pool
+        if more than one job was requested
+
+        theFunction: The function to call, such as HashFile
+        theArgs:     Lists of arguments, as for map
+
+        returns: An iterator of the results, in the order of the arguments
+    """
+    if JOBS < 2:
+        return map(theFunction, *theArgs)
+    with ThreadPoolExecutor(JOBS, thread_name_prefix="Hasher") as pool:
+        return iter(list(pool.map(theFunction, *theArgs)))
+
+def mapInodes(theFunction, theInodes, *theArgs):
+    """ Apply a function to each of a list of files, as for mapFiles, but only call it
+        once for files that are hard links to each other
+
+        theFunction: The function to call, such as HashFile
+        theInodes:   A list of (device, inode) tuples, one for each file
+        theArgs:     Lists of arguments, as for map
+
+        returns: A list of the results, in the order of the arguments
+    """
+    first = {}
+    for i, inode in enumerate(theInodes):
+        first.setdefault(inode if None not in inode else i, i)
+    unique = sorted(first.values())
+    results = dict(zip(unique, mapFiles(theFunction, *[[x[i] for i in unique] for x in theArgs])))
+    return [results[first[inode if None not in inode else i]] for i, inode in enumerate(theInodes)]
+
+def isImage(theFile):
+    """ Check whether a file may hold exif data that GExiv2 can read, first by its
+        extension, then by its first bytes
+
+        theFile: The full path to the file
+        returns: True if the file looks like an image.  False otherwise
+    """
+    if os.path.splitext(theFile)[1].lower() in exifExtensions:
+        return True
+    with open(theFile, 'rb') as afile:
+        header = afile.read(16)
+    if header.startswith(exifSignatures):
+        return True
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return True
+    return header[4:8] == b"ftyp" and header[8:12] in exifBrands
+
+def loadExif():
+    """ Import GExiv2, if it has not been imported already
+
+        returns: True if GExiv2 is available.  False otherwise
+    """
+    global exifAvailable
+    global GExiv2
+    if exifAvailable is None:
+        try:
+            import gi
+            gi.require_version('GExiv2', '0.10')
+            from gi.repository import GExiv2
+            exifAvailable=True
+        except ImportError:
+            exifAvailable=False
+        except ValueError:
+            exifAvailable=False
+    return exifAvailable
+
+def ReadExif(theHash, theFile):
+    """ Read the interesting exif data from a file.  This is called in a worker
+        process by mapIsolated
+
+        theHash: The hash of the file
+        theFile: The full path to the file
+        returns: A (hash, dateTime, latitude, longitude, altitude) tuple.  Tags that
+                 the file does not have are None
+    """
+    logging.debug("Getting exif data for  %s", theFile)
+    loadExif()
+    record = [theHash, None, None, None, None]
+    exif = GExiv2.Metadata(theFile)
+    if not exif:
+        logging.warning("EXIF data not available")
+        return tuple(record)
+    for (i, tag) in enumerate(('get_date_time', 'get_gps_latitude', 'get_gps_longitude',
+                               'get_gps_altitude'), 1):
+        try:
+            theData = getattr(exif, tag)()
+            record[i] = normalDateTime(theData) if i == 1 else theData
+        except KeyError:
+            logging.info("File %s has no tag %s", theFile, tag)
+        except ValueError:
+            logging.warning("File %s: Cannot decode %s", theFile, tag)
+    return tuple(record)
+
+def IsolatedWorker(theFunction, theConnection):
+    """ Body of a worker process for mapIsolated.  Call a function for each tuple of
+        arguments received on a connection, and send back the result, until None is
+        received
+
+        theFunction:   The function to call
+        theConnection: The worker's end of a pipe to the parent
+        returns:       None
+    """
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            theArgs = theConnection.recv()
+        except EOFError:
+            return
+        if theArgs is None:
+            return
+        try:
+            theConnection.send((theFunction(*theArgs), None))
+        except Exception as e:
+            theConnection.send((None, "%s: %s" % (type(e).__name__, e)))
+
+def mapIsolated(theFunction, theArgs, theJobs):
+    """ Apply a function to each of a sequence of argument tuples in a pool of worker
+        processes, for work that may crash or hang the process that does it.  A worker
+        that dies, or takes longer than ISOLATED_TIMEOUT seconds, is replaced, and only
+        the call it was making is lost
+
+        theFunction: The function to call.  It must be defined at the top level of
+                     this module
+        theArgs:     An iterable of tuples of arguments.  It is read as workers
+                     become free
+        theJobs:     The number of worker processes
+
+        returns: A generator of (arguments, result, error) tuples, in the order the
+                 calls finish.  error is None, or a string describing why the call failed
+    """
+    import multiprocessing
+    import multiprocessing.connection
+    context = multiprocessing.get_context("forkserver")
+    theArgs = iter(theArgs)
+    (idle, busy) = ([], {})
+
+    def spawn():
+        (parentEnd, childEnd) = context.Pipe()
+        process = context.Process(target=IsolatedWorker, args=(theFunction, childEnd),
+                                  name="Worker", daemon=True)
+        process.start()
+        childEnd.close()
+        return (parentEnd, process)
+
+    # A worker that has died is replaced by a new one.  Its pipe may be closed, or
+    # reset if the worker died with data that it had not read
+
+    def replace(theConnection, theProcess):
+        theProcess.join()
+        theConnection.close()
+        idle.append(spawn())
+        return "worker exited with code %s" % theProcess.exitcode
+
+    try:
+        idle.extend(spawn() for i in range(max(1, theJobs)))
+        exhausted = False
+        while True:
+            while idle and not exhausted:
+                args = next(theArgs, None)
+                if args is None:
+                    exhausted = True
+                    break
+                (connection, process) = idle.pop()
+                try:
+                    connection.send(args)
+                except OSError:
+                    yield (args, None, replace(connection, process))
+                    continue
+                busy[connection] = (process, args, time.monotonic())
+            if not busy:
+                return
+            for connection in multiprocessing.connection.wait(list(busy), timeout=1):
+                (process, args, started) = busy.pop(connection)
+                try:
+                    (result, error) = connection.recv()
+                    idle.append((connection, process))
+                except (EOFError, OSError):
+                    (result, error) = (None, replace(connection, process))
+                yield (args, result, error)
+
+            # A worker that has hung is killed.  Its end of the pipe then closes, and
+            # the call is reported as failed above
+
+            for (process, args, started) in busy.values():
+                if time.monotonic() - started > ISOLATED_TIMEOUT:
+                    logging.warning("Stopping worker that has taken more than %d seconds on %s",
+                                    ISOLATED_TIMEOUT, args[-1])
+                    process.kill()
+    finally:
+        for (connection, process) in idle + [(x, busy[x][0]) for x in busy]:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+def readBlock(theFile, theView):
+    """ Read from a file into a buffer until the buffer is full or the file ends
+
+        theFile: A file opened for unbuffered binary reading
+        theView: A memoryview of the buffer
+        returns: The number of bytes read
+    """
+    total = 0
+    while total < len(theView):
+        length = theFile.readinto(theView[total:])
+        if not length:
+            break
+        total += length
+    return total
+
+def compareFiles(theReference, theFiles):
+    """ Compare files with a reference file, byte by byte
+
+        theReference: The full path to the reference file
+        theFiles:     A list of the full paths to the files to compare with it
+        returns:      A set of the files in theFiles that are identical to the reference
+
+        The reference and the files are read side by side, BLOCKSIZE bytes at a time,
+        so each file is read once, and not past its first difference from the
+        reference.  Reading stops when no file still matches.  At most COMPARE_FILES
+        files are open at once.  If there are more, the reference is read again for
+        each COMPARE_FILES files.  A file that cannot be read is not identical.
+    """
+    identical = set()
+    (start, total) = (time.perf_counter(), 0)
+    (buf, other) = (bytearray(BLOCKSIZE), bytearray(BLOCKSIZE))
+    (view, otherView) = (memoryview(buf), memoryview(other))
+    for i in range(0, len(theFiles), COMPARE_FILES):
+        files = {}
+        try:
+            with open(theReference, 'rb', buffering=0) as reference:
+                for x in theFiles[i:i + COMPARE_FILES]:
+                    try:
+                        files[x] = open(x, 'rb', buffering=0)
+                    except OSError as e:
+                        logging.warning("Unable to read %s: %s", x, e)
+                while files:
+                    length = readBlock(reference, view)
+                    total += length
+
+                    # At the end of the reference, a file that can still be read is longer
+
+                    for x in list(files):
+                        try:
+                            otherLength = readBlock(files[x], otherView[:length or 1])
+                        except OSError as e:
+                            logging.warning("Unable to read %s: %s", x, e)
+                            otherLength = None
+                        total += otherLength or 0
+                        if otherLength != length or otherView[:length] != view[:length]:
+                            logging.debug("%s differs from %s", x, theReference)
+                            files.pop(x).close()
+                    if not length:
+                        identical.update(files)
+                        break
+        except OSError as e:
+            logging.warning("Unable to read %s: %s", theReference, e)
+        finally:
+            for afile in files.values():
+                afile.close()
+    STATS.addTime("compare", time.perf_counter() - start)
+    STATS.count("bytes_compared", total)
+    return identical
+
+def LinkFile(theFile, theTarget, theMode):
+    """ Replace a file with a link to an identical file.  The link is made under a
+        temporary name in the same directory, then renamed over the file, so the file
+        is never missing
+
+        theFile:   The full path to the file to replace
+        theTarget: The full path to the file to link to.  It must be on the same
+                   file system
+        theMode:   "hard" to make a hard link, or "reflink" to make a copy on write
+                   clone that shares the data of theTarget (btrfs, xfs).  A clone
+                   keeps the owner, group, permissions and times of theFile.  The
+                   owner is only kept if the purge is allowed to set it
+        returns:   None
+    """
+    temporary = os.path.join(os.path.dirname(theFile),
+                             ".%s.dup-%d" % (os.path.basename(theFile), os.getpid()))
+    try:
+        if theMode == "hard":
+            os.link(theTarget, temporary)
+        else:
+            with open(theTarget, 'rb') as source, open(temporary, 'xb') as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            shutil.copystat(theFile, temporary)
+            theStat = os.stat(theFile)
+            try:
+                os.chown(temporary, theStat.st_uid, theStat.st_gid)
+            except PermissionError:
+                logging.info("Unable to keep the owner of %s", theFile)
+        os.replace(temporary, theFile)
+    except BaseException:
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        raise
+
+def sameInode(theStat, theOtherStat):
+    """ Check whether two os.stat results are for the same file, for example
+        because they are hard links to each other
+
+        returns: True if they are the same file.  False otherwise
+    """
+    return (theStat.st_dev, theStat.st_ino) == (theOtherStat.st_dev, theOtherStat.st_ino)
+
+def queueRecords(theQueue):
+    """ Yield the records placed on a queue until None is received.  An empty tuple is
+        yielded whenever no record has arrived for a second, so that Database.writeMany
+        can commit a batch that has been waiting
+
+        theQueue: A queue of records for Database.writeMany, terminated by None
+        returns:  A generator of records
+    """
+    while True:
+        try:
+            record = theQueue.get(timeout=1)
+        except queue.Empty:
+            record = ()
+        if record is None:
+            return
+        yield record
+
+def WriteResults(theFileName, theQueue, theErrors):
+    """ Body of the writer thread used by a parallel scan.  The writer thread opens its
+        own connection to the database and is the only thread that writes to it.
+
+        theFileName: The name of the database file
+        theQueue:    A queue of (hash, path, FileStat, partial) tuples, terminated by None
+        theErrors:   A list to which any exception raised by the writer is appended
+
+        returns: None
+    """
+    writer = Database(theFileName)
+    try:
+        writer.writeMany(queueRecords(theQueue))
+    except Exception as e:
+        logging.error("Unable to write to the database: %s", e)
+        theErrors.append(e)
+
+        # Keep draining the queue so that the hashing threads are not blocked
+
+        while theQueue.get() is not None:
+            pass
+    finally:
+        writer.close()
+
+def HashDirParallel(thePath):
+    """ Obtain hash for contents of all files in a directory tree using JOBS
+        hashing threads and a single database writer thread.
+
+        thePath:  A string that specifies the top directory tree
+
+        returns: None
+
+        If the scan is interrupted, files that are being hashed are finished, files
+        that have not been started are abandoned, and everything that was hashed is
+        committed before the interruption is passed on.
+    """
+    results = queue.Queue(maxsize=BATCHSIZE * 2)
+    slots = threading.BoundedSemaphore(JOBS * 4)
+    errors = []
+    writer = threading.Thread(target=WriteResults, name="Writer",
+                              args=(theDatabase.fileName, results, errors))
+
+    def hashOne(theFilePath, theStat):
+        try:
+            if not errors:
+                theHash = HashFile(theFilePath)
+                results.put((theHash, theFilePath, theStat, None))
+                return theHash
+        except Exception as e:
+            logging.error("Unable to hash %s: %s", theFilePath, e)
+        finally:
+            slots.release()
+
+    def linkDone(theFilePath, theStat):
+
+        # Another link to this file is being hashed.  Write this one when it is done
+
+        def done(theFuture):
+            if not theFuture.cancelled():
+                results.put((theFuture.result(), theFilePath, theStat, None))
+        return done
+
+    # A file with more than one hard link is only hashed once.  seen holds the hash,
+    # or the future that will return it, of each such file
+
+    seen = {}
+    writer.start()
+    pool = ThreadPoolExecutor(JOBS, thread_name_prefix="Hasher")
+    try:
+        for theFilePath, theStat, theLinks in ChangedFiles(thePath):
+            if theLinks > 1:
+                inode = (theStat.device, theStat.inode)
+                if inode not in seen:
+                    seen[inode] = theDatabase.linkedHash(theStat)
+                if isinstance(seen[inode], Future):
+                    seen[inode].add_done_callback(linkDone(theFilePath, theStat))
+                    continue
+                if seen[inode]:
+                    results.put((seen[inode], theFilePath, theStat, None))
+                    continue
+            slots.acquire()
+            if errors:
+                break
+            future = pool.submit(hashOne, theFilePath, theStat)
+            if theLinks > 1:
+                seen[inode] = future
+        pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        logging.warning("Interrupted.  Saving the files hashed so far")
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        results.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
 
 def HashDir(thePath):
     """ Obtain hash for contents of all files in a directory tree
 
-        theURL:  A string that specifies the top directory tree
+        thePath:  A string that specifies the top directory tree
 
         returns: None
+
+        Progress is recorded in a ScanSession, so a scan that is interrupted can be
+        continued with RESUME.
     """
+    global SESSION
     logging.debug("Adding %s to database", thePath)
-    for root, dirs, files in os.walk(thePath):
-        for theFile in files:
-            theFilePath = os.path.abspath("%s/%s"%(root, theFile))
-            if theDatabase:
-                theDatabase.write(HashFile(theFilePath), theFilePath)
+    if not theDatabase:
+        return
+
+    # The number of files already recorded under the path is the best guess we have
+    # of how many files the scan will find
+
+    if STATS.enabled:
+        (condition, parameters) = pathRange(os.path.abspath(thePath))
+        STATS.expect(theDatabase.con.execute("select count(*) from files where %s" % condition,
+                                             parameters).fetchone()[0], "files_walked")
+    SESSION = ScanSession(theDatabase, thePath)
+    try:
+        if STAGED:
+            theDatabase.stagedWrite(ChangedFiles(thePath, needHash=False))
+        elif JOBS > 1:
+            HashDirParallel(thePath)
+        else:
+            theDatabase.writeMany(HashFiles(ChangedFiles(thePath)))
+        SESSION.finish()
+    finally:
+        SESSION = None
     
 
+class Watcher(object):
+    """ Keep the database up to date with a directory tree, using inotify.
+
+        Files that are created or changed are hashed once they have had no events
+        for WATCH_DELAY seconds, so a file that is being written is only hashed
+        when it is finished.  Files and directories that are deleted are removed
+        from the database, and those that are renamed within the tree are renamed
+        in the database without being read.  A file or directory that is moved out
+        of the tree is treated as deleted, and one moved into it as created.  The
+        files and directories that WalkDir would skip, because of EXCLUDE, MIN_SIZE,
+        MAX_SIZE, ONE_FILE_SYSTEM or SYMLINKS, are skipped here too.
+    """
+
+    # Constants from <sys/inotify.h>
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    def __init__(self, thePath):
+        """ Constructor.  Starts watching every directory in the tree
+
+            thePath: A string that specifies the top directory tree
+        """
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.root = os.path.abspath(thePath)
+        try:
+            self.device = os.stat(self.root).st_dev
+        except OSError:
+            self.device = None
+        self.dirs = {}       # The directory of each watch
+        self.pending = {}    # The time of the last event for each file to be hashed
+        self.moves = {}      # The path, type and time of each file moved away, by cookie
+        self.overflow = False
+        self.addTree(self.root)
+
+    def addTree(self, thePath, theScan=False):
+        """ Watch a directory and every directory in it
+
+            thePath: The full path of the directory
+            theScan: If True, hash the files found in the directories as well.  This is
+                     for directories that are created or moved into the tree while
+                     it is being watched
+            returns: None
+        """
+        stack = [thePath]
+        while stack:
+            directory = stack.pop()
+
+            # Watch the directory before listing it, so no file created in it is missed.
+            # A link to a directory is only reached when SYMLINKS is "follow", and then
+            # the directory it points to is watched
+
+            mask = self.MASK & ~self.IN_DONT_FOLLOW if os.path.islink(directory) else self.MASK
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    logging.warning("Out of inotify watches.  See /proc/sys/fs/inotify/max_user_watches")
+                logging.warning("Unable to watch %s: %s", directory, os.strerror(error))
+                continue
+
+            # When links are followed, a directory may be reached more than once
+
+            if self.dirs.get(wd, directory) != directory:
+                continue
+            self.dirs[wd] = directory
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                logging.warning("Unable to read directory %s: %s", directory, e)
+                continue
+            for entry in entries:
+                if isExcluded(entry.path):
+                    logging.debug("Excluding %s", entry.path)
+                    continue
+                try:
+                    isLink = entry.is_symlink()
+                    if entry.is_dir(follow_symlinks=False) or (isLink and SYMLINKS == "follow" and entry.is_dir()):
+                        if ONE_FILE_SYSTEM and entry.stat(follow_symlinks=isLink).st_dev != self.device:
+                            logging.info("Skipping %s on another file system", entry.path)
+                            continue
+                        stack.append(entry.path)
+                    elif theScan:
+                        self.pending[entry.path] = time.monotonic()
+                except OSError:
+                    logging.warning("File %s no longer exists", entry.path)
+
+    def forgetTree(self, thePath):
+        """ Stop watching a directory and every directory in it
+
+            thePath: The full path of the directory
+            returns: None
+        """
+        for wd in [x for x, y in self.dirs.items() if y == thePath or y.startswith(thePath + "/")]:
+            libc.inotify_rm_watch(self.fd, wd)
+            del self.dirs[wd]
+
+    def run(self):
+        """ Watch the tree until interrupted
+
+            returns: None
+        """
+        logging.warning("Watching %s for changes", self.root)
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        try:
+            while True:
+                times = list(self.pending.values()) + [x[2] for x in self.moves.values()]
+                timeout = None
+                if times:
+                    timeout = max(0, int((min(times) + WATCH_DELAY - time.monotonic()) * 1000) + 1)
+                if poller.poll(timeout):
+                    self.readEvents()
+                self.flush()
+        finally:
+            os.close(self.fd)
+
+    def readEvents(self):
+        """ Read and handle the events that are waiting
+
+            returns: None
+        """
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            self.event(wd, mask, cookie, name)
+
+    def event(self, theWatch, theMask, theCookie, theName):
+        """ Handle one inotify event
+
+            theWatch:  The watch descriptor of the directory
+            theMask:   The inotify event mask
+            theCookie: The cookie that connects the two events of a rename
+            theName:   The name of the file in the directory
+            returns:   None
+        """
+        if theMask & self.IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if theMask & self.IN_IGNORED:
+            self.dirs.pop(theWatch, None)
+            return
+        directory = self.dirs.get(theWatch)
+        if directory is None or not theName:
+            return
+        thePath = os.path.join(directory, theName)
+        isDir = bool(theMask & self.IN_ISDIR)
+        now = time.monotonic()
+        if theMask & self.IN_MOVED_FROM:
+            self.moves[theCookie] = (thePath, isDir, now)
+        elif theMask & self.IN_MOVED_TO:
+            move = self.moves.pop(theCookie, None)
+            if move:
+                self.rename(move[0], thePath, isDir)
+            elif isDir:
+                if not isExcluded(thePath):
+                    logging.info("Directory %s moved into the tree", thePath)
+                    self.addTree(thePath, True)
+            else:
+                self.pending[thePath] = now
+        elif theMask & self.IN_DELETE:
+            logging.info("Removing %s from the database", thePath)
+            self.pending.pop(thePath, None)
+            theDatabase.removePath(thePath)
+        elif isDir:
+            if theMask & self.IN_CREATE and not isExcluded(thePath):
+                self.addTree(thePath, True)
+        else:
+            self.pending[thePath] = now
+
+    def rename(self, theOldPath, theNewPath, isDir):
+        """ Handle a file or directory that has been renamed within the tree
+
+            returns: None
+        """
+        # A file or directory renamed to a name that is excluded is treated as deleted,
+        # and a directory renamed from one as created
+
+        if isExcluded(theNewPath):
+            logging.info("%s renamed to an excluded name.  Removing it from the database", theOldPath)
+            self.pending.pop(theOldPath, None)
+            if isDir:
+                self.forgetTree(theOldPath)
+                for thePath in [x for x in self.pending if x.startswith(theOldPath + "/")]:
+                    del self.pending[thePath]
+            theDatabase.removePath(theOldPath)
+            return
+        if isDir and isExcluded(theOldPath):
+            logging.info("Directory %s renamed from an excluded name", theNewPath)
+            self.addTree(theNewPath, True)
+            return
+        logging.info("Renaming %s to %s in the database", theOldPath, theNewPath)
+        theDatabase.movePath(theOldPath, theNewPath)
+        now = time.monotonic()
+        if not isDir:
+
+            # The file may not have been hashed yet.  If it has, it is current, and
+            # will not be hashed again
+
+            self.pending.pop(theOldPath, None)
+            self.pending[theNewPath] = now
+            return
+        for (wd, directory) in list(self.dirs.items()):
+            if directory == theOldPath or directory.startswith(theOldPath + "/"):
+                self.dirs[wd] = theNewPath + directory[len(theOldPath):]
+        for thePath in [x for x in self.pending if x.startswith(theOldPath + "/")]:
+            self.pending[theNewPath + thePath[len(theOldPath):]] = self.pending.pop(thePath)
+
+    def flush(self):
+        """ Hash the files that have had no events for WATCH_DELAY seconds, and treat
+            files that were moved away, and did not reappear in the tree, as deleted
+
+            returns: None
+        """
+        now = time.monotonic()
+        if self.overflow:
+            logging.warning("Too many changes to follow.  Rescanning %s", self.root)
+            (self.overflow, self.pending, self.moves) = (False, {}, {})
+            self.addTree(self.root)
+            HashDir(self.root)
+            return
+        for (theCookie, (thePath, isDir, when)) in list(self.moves.items()):
+            if now - when >= WATCH_DELAY:
+                logging.info("%s moved out of the tree.  Removing it from the database", thePath)
+                del self.moves[theCookie]
+                self.pending.pop(thePath, None)
+                if isDir:
+                    self.forgetTree(thePath)
+                theDatabase.removePath(thePath)
+        entries = []
+        for thePath in [x for x, when in self.pending.items() if now - when >= WATCH_DELAY]:
+            del self.pending[thePath]
+            if isExcluded(thePath):
+                continue
+            try:
+                theStat = os.lstat(thePath)
+                if stat.S_ISLNK(theStat.st_mode):
+                    if SYMLINKS == "skip":
+                        continue
+                    theStat = os.stat(thePath)
+                    if SYMLINKS == "follow" and stat.S_ISDIR(theStat.st_mode):
+                        if not (ONE_FILE_SYSTEM and theStat.st_dev != self.device):
+                            self.addTree(thePath, True)
+                        continue
+            except OSError:
+                continue
+            if not stat.S_ISREG(theStat.st_mode) or not isSelectedSize(theStat.st_size):
+                continue
+            if REHASH or not theDatabase.isCurrent(thePath, fileStat(theStat)):
+                entries.append((thePath, fileStat(theStat), theStat.st_nlink))
+        if entries:
+            logging.info("Hashing %d changed files", len(entries))
+            theDatabase.writeMany(HashFiles(entries))
+
+def loadInotify():
+    """ Find the inotify functions in the C library, if that has not been done already
+
+        returns: True if inotify is available.  False otherwise
+    """
+    global inotifyAvailable
+    global ctypes
+    global libc
+    if inotifyAvailable is None:
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.inotify_init1
+            inotifyAvailable=True
+        except (OSError, AttributeError):
+            inotifyAvailable=False
+    return inotifyAvailable
+
+def WatchDir(thePath):
+    """ Keep the database up to date with a directory tree until interrupted
+
+        thePath:  A string that specifies the top directory tree
+
+        returns: None
+    """
+    if not loadInotify():
+        logging.warning("Watching is not available.  It requires Linux inotify")
+        return
+    Watcher(thePath).run()
+
 def setLog(enableLog, LogLevelStr):
     """Set the log level to be used during this run.  This program
        uses logging to provide warning, info, and debug level messages.
@@ -617,22 +3244,73 @@ def main():
         ('dryrun'   ,'store_false' ,None ,'--commit'    ,None                              ,"Really delete things"                          ,True      ),
         ('INFO'     ,'store_true'  ,'-v' ,'--verbose'   ,lambda x: setLog(x,'INFO')        ,"Generate information"                          ,None      ),
         ('DEBUG'    ,'store_true'  ,None ,'--debug'     ,lambda x: setLog(x,'DEBUG')       ,"Generate debugging information"                ,None      ),
+        ('stats'    ,'store_true'  ,None ,'--stats'     ,None                              ,"Show progress and statistics"                  ,None      ),
+        ('statsFile','store'       ,None ,'--stats-json',None                              ,"Write statistics to given file as JSON"        ,None      ),
+        ('profile'  ,'store'       ,None ,'--profile'   ,None                              ,"Write cProfile statistics to given file"       ,None      ),
+        ('memory'   ,'store_true'  ,None ,'--tracemalloc',None                             ,"Report the largest memory allocations"         ,None      ),
         ('database' ,'store'       ,None ,'--database'  ,lambda x: initDB(x)               ,"Select database name"                          ,default_DB),
+        ('staged'   ,'store_true'  ,None ,'--staged'    ,None                              ,"Only hash files that may be duplicates"        ,None      ),
+        ('rehash'   ,'store_true'  ,None ,'--rehash'    ,None                              ,"Rehash files that appear unchanged"            ,None      ),
+        ('algorithm','store'       ,None ,'--hash'      ,None                              ,"Hash algorithm: %s" % ", ".join(sorted(hashAlgorithms)),None),
+        ('blocksize','store'       ,None ,'--blocksize' ,None                              ,"Size of the blocks read when hashing, in bytes",None      ),
+        ('jobs'     ,'store'       ,'-j' ,'--jobs'      ,None                              ,"Number of files to hash in parallel"           ,1         ),
+        ('exclude'  ,'append'      ,None ,'--exclude'   ,None                              ,"Skip files and directories matching a pattern" ,None      ),
+        ('minSize'  ,'store'       ,None ,'--min-size'  ,None                              ,"Skip files smaller than given size, in bytes"  ,None      ),
+        ('maxSize'  ,'store'       ,None ,'--max-size'  ,None                              ,"Skip files larger than given size, in bytes"   ,None      ),
+        ('oneFS'    ,'store_true'  ,'-x' ,'--one-file-system',None                         ,"Do not scan other file systems"                ,None      ),
+        ('symlinks' ,'store'       ,None ,'--symlinks'  ,None                              ,"Symbolic links: skip, files or follow"         ,"files"   ),
         ('path'     ,'store'       ,'-p' ,'--path'      ,lambda x: HashDir(x)              ,"Scan a directory tree into database"           ,None      ),
+        ('verify'   ,'store'       ,None ,'--verify'    ,None                              ,"Integrity check: stat, sample or full"         ,"full"    ),
+        ('sample'   ,'store'       ,None ,'--sample'    ,None                              ,"Percent of files to rehash for --verify sample",1.0       ),
+        ('resume'   ,'store_true'  ,None ,'--resume'    ,None                              ,"Continue an interrupted check or scan"         ,None      ),
         ('check'    ,'store_true'  ,'-c' ,'--check'     ,lambda x: theDatabase.Integrity() ,"Check database for integrity"                  ,None      ),
+        ('format'   ,'store'       ,None ,'--format'    ,None                              ,"Output format: text, json or csv"              ,"text"    ),
         ('duplicate','store_true'  ,'-d' ,'--duplicate' ,lambda x: theDatabase.DupCheck()  ,"Check for duplicates in database"              ,None      ),
+        ('dupdirs'  ,'store_true'  ,None ,'--duplicate-dirs',lambda x: theDatabase.DupDirs(),"Check for duplicate directories in database"   ,None      ),
+        ('host'     ,'store'       ,None ,'--host'      ,None                              ,"Host name to record with --export"             ,None      ),
+        ('export'   ,'store'       ,None ,'--export'    ,lambda x: theDatabase.Export(x)   ,"Export hashes to given file for --merge"       ,None      ),
+        ('merge'    ,'append'      ,None ,'--merge'     ,lambda x: theDatabase.Merge(x)    ,"Find duplicates across files from --export"    ,None      ),
+        ('link'     ,'store'       ,None ,'--link'      ,None                              ,"Purge by linking: hard or reflink"             ,None      ),
+        ('subtree'  ,'store_true'  ,None ,'--subtree'   ,None                              ,"Purge the whole tree below the --purge path"   ,None      ),
         ('purge'    ,'store'       ,None ,'--purge'     ,lambda x: theDatabase.Purge(x)    ,"Purge duplicate files"                         ,None      ),
         ('remove'   ,'store'       ,None ,'--remove'    ,lambda x: theDatabase.Remove(x)   ,"Remove files from database"                    ,None      ),
         ('exif'     ,'store_true'  ,None ,'--exif'      ,lambda x: theDatabase.getExif()   ,"Obtain metadata for all files"                 ,None      ),
+        ('unique'   ,'store_true'  ,None ,'--unique'    ,None                              ,"Output one file for each hash by date"         ,None      ),
+        ('since'    ,'store'       ,None ,'--since'     ,None                              ,"Output file paths by date since given date"    ,None      ),
         ('byDate'   ,'store'       ,None ,'--byDate'    ,lambda x: theDatabase.byDate(x)   ,"Output file paths by date since param"         ,None      ),
+        ('until'    ,'store'       ,None ,'--until'     ,lambda x: theDatabase.byDate(SINCE, x),"Output file paths by date until given date",None      ),
+        ('limit'    ,'store'       ,None ,'--limit'     ,None                              ,"Number of files to output by distance or date" ,None      ),
+        ('radius'   ,'store'       ,None ,'--radius'    ,None                              ,"Only output files within given distance, in km",None      ),
         ('lat'      ,'store'       ,None ,'--lat'       ,lambda x: theDatabase.lat(x)      ,"Latitude. required for file paths by distance" ,None      ),
         ('long'     ,'store'       ,None ,'--long'      ,lambda x: theDatabase.long(x)     ,"Longitude, required for file paths by distance",None      ),
         ('map'      ,'store'       ,None ,'--map'       ,lambda x: theDatabase.map(x)      ,"Generate geolocation map to given file name"   ,None      ),
+        ('watch'    ,'store'       ,None ,'--watch'     ,lambda x: WatchDir(x)             ,"Keep database up to date with directory tree"  ,None      ),
     )
 
     global theDatabase
     global DRY_RUN
-    global argcompleteAvailable 
+    global STAGED
+    global REHASH
+    global JOBS
+    global ALGORITHM
+    global BLOCKSIZE
+    global OUTPUT_FORMAT
+    global VERIFY
+    global SAMPLE
+    global RESUME
+    global LINK_MODE
+    global SUBTREE
+    global HOST
+    global EXCLUDE
+    global MIN_SIZE
+    global MAX_SIZE
+    global ONE_FILE_SYSTEM
+    global SYMLINKS
+    global LIMIT
+    global RADIUS
+    global UNIQUE
+    global SINCE
+    global UNTIL
     # Handle all the command line nonsense.
 
     description = "Manage duplicate files"
@@ -640,11 +3318,124 @@ def main():
     for x in theParameters:
         if x[2]: parser.add_argument(x[2] ,x[3], action=x[1], dest=x[0], help=x[5], default=x[6])
         else: parser.add_argument(x[3], action=x[1], dest=x[0], help=x[5], default=x[6])
-    if argcompleteAvailable:
-        argcomplete.autocomplete(parser)
+
+    # argcomplete sets _ARGCOMPLETE when it runs the program to complete a command line.
+    # autocomplete then prints the completions and exits, before the database is opened
+
+    if "_ARGCOMPLETE" in os.environ:
+        try:
+            import argcomplete
+            argcomplete.autocomplete(parser)
+        except ImportError:
+            pass
+        return
     args = parser.parse_args()
     DRY_RUN = args.dryrun
-    [x[4](getattr(args, x[0])) for x in theParameters if x[4] and getattr(args, x[0])]
+    STAGED = args.staged
+    REHASH = args.rehash
+    try:
+        JOBS = max(1, int(args.jobs))
+    except ValueError:
+        parser.error("argument -j/--jobs: invalid number of jobs: %s" % args.jobs)
+    if args.algorithm:
+        if args.algorithm not in hashAlgorithms:
+            parser.error("argument --hash: invalid choice: %s (choose from %s)" %
+                         (args.algorithm, ", ".join(sorted(hashAlgorithms))))
+        ALGORITHM = args.algorithm
+    if args.blocksize:
+        try:
+            BLOCKSIZE = int(args.blocksize)
+            if BLOCKSIZE < 1:
+                raise ValueError
+        except ValueError:
+            parser.error("argument --blocksize: invalid block size: %s" % args.blocksize)
+    if args.format not in ("text", "json", "csv"):
+        parser.error("argument --format: invalid choice: %s (choose from text, json, csv)" % args.format)
+    OUTPUT_FORMAT = args.format
+    if args.verify not in ("stat", "sample", "full"):
+        parser.error("argument --verify: invalid choice: %s (choose from stat, sample, full)" % args.verify)
+    VERIFY = args.verify
+    try:
+        SAMPLE = float(args.sample)
+    except ValueError:
+        parser.error("argument --sample: invalid percentage: %s" % args.sample)
+    RESUME = args.resume
+    if args.link not in (None, "hard", "reflink"):
+        parser.error("argument --link: invalid choice: %s (choose from hard, reflink)" % args.link)
+    LINK_MODE = args.link
+    SUBTREE = args.subtree
+    try:
+        LIMIT = int(args.limit) if args.limit else None
+        if LIMIT is not None and LIMIT < 1:
+            raise ValueError
+    except ValueError:
+        parser.error("argument --limit: invalid number of files: %s" % args.limit)
+    try:
+        RADIUS = float(args.radius) if args.radius else None
+    except ValueError:
+        parser.error("argument --radius: invalid distance: %s" % args.radius)
+    UNIQUE = args.unique
+    HOST = args.host
+    if args.exclude:
+        EXCLUDE = re.compile("|".join(fnmatch.translate(x) for x in args.exclude))
+    for (x, option) in (("minSize", "--min-size"), ("maxSize", "--max-size")):
+        try:
+            if getattr(args, x) is not None:
+                setattr(args, x, int(getattr(args, x)))
+        except ValueError:
+            parser.error("argument %s: invalid size: %s" % (option, getattr(args, x)))
+    (MIN_SIZE, MAX_SIZE) = (args.minSize, args.maxSize)
+    ONE_FILE_SYSTEM = args.oneFS
+    if args.symlinks not in ("skip", "files", "follow"):
+        parser.error("argument --symlinks: invalid choice: %s (choose from skip, files, follow)" % args.symlinks)
+    SYMLINKS = args.symlinks
+
+    # --since is --byDate by another name.  With --until, the query is made once, by --until
+
+    args.byDate = args.byDate or args.since
+    for x in ("byDate", "until"):
+        try:
+            if getattr(args, x):
+                setattr(args, x, dateBound(getattr(args, x)))
+        except ValueError:
+            parser.error("argument --%s: invalid date: %s" % (x, getattr(args, x)))
+    (SINCE, UNTIL) = (args.byDate, args.until)
+    if args.until:
+        args.byDate = None
+    STATS.enabled = bool(args.stats or args.statsFile)
+    if args.memory:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.enable()
+        for x in theParameters:
+            if x[4] and getattr(args, x[0]):
+                STATS.startPhase(x[0])
+                x[4](getattr(args, x[0]))
+                STATS.endPhase()
+    except KeyboardInterrupt:
+        logging.warning("Interrupted")
+        theDatabase.close()
+        sys.exit(130)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        STATS.endPhase()
+        if STATS.enabled:
+            STATS.report(args.statsFile)
+        if args.memory:
+            (current, peak) = tracemalloc.get_traced_memory()
+            sys.stderr.write("Memory: %.1f MB in use, %.1f MB peak.  Largest allocations:\n" %
+                             (current / 1048576.0, peak / 1048576.0))
+            for x in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+                sys.stderr.write("  %s\n" % x)
+            tracemalloc.stop()
     theDatabase.close()
     logging.info("Done")
 